@@ -0,0 +1,148 @@
+# coding=utf-8
+from decimal import Decimal
+
+import arrow
+
+import helpers
+import metrics
+
+
+def sqlite_get_table_names(cursor):
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name!='sqlite_sequence' ORDER BY name")
+    return [row[0] for row in cursor.fetchall()]
+
+
+@metrics.timed('sqlite_query')
+def sqlite_get_rows_between_ts(cursor, table_name, start_ts, end_ts, limit=-1):
+    # A negative limit means no limit in sqlite
+    cursor.execute(
+        'SELECT id, ts, temperature FROM %s WHERE ts>? and ts<=? ORDER BY ts LIMIT ?' % table_name,
+        (start_ts, end_ts, limit))
+    return cursor.fetchall()
+
+
+def sqlite_iter_rows(cursor, table_name, start_ts, end_ts, batch_size):
+    """Yield lists of at most batch_size rows in ts order. Only one batch is held in memory."""
+
+    where = []
+    params = []
+
+    if start_ts:
+        where.append('ts>?')
+        params.append(start_ts)
+
+    if end_ts:
+        where.append('ts<=?')
+        params.append(end_ts)
+
+    query = 'SELECT ts, temperature FROM %s' % table_name
+    if where:
+        query += ' WHERE ' + ' AND '.join(where)
+    query += ' ORDER BY ts'
+
+    cursor.execute(query, params)
+
+    while True:
+        with metrics.span('sqlite_query', table=table_name):
+            rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield rows
+
+
+@metrics.timed('sqlite_query')
+def sqlite_get_stats_between_ts(cursor, table_name, start_ts, end_ts):
+    cursor.execute(
+        'SELECT COUNT(temperature), MIN(temperature), MAX(temperature), SUM(temperature) FROM %s '
+        'WHERE ts>? and ts<=?' % table_name, (start_ts, end_ts))
+    return cursor.fetchone()
+
+
+@metrics.timed('sqlite_query')
+def sqlite_get_min_and_max_rows_between_ts(cursor, table_name, start_ts, end_ts):
+    # The first row by id wins ties, like min() and max() over rows ordered by id
+    rows = []
+    for order in ('ASC', 'DESC'):
+        cursor.execute(
+            'SELECT id, ts, temperature FROM %s WHERE ts>? and ts<=? ORDER BY temperature %s, id LIMIT 1'
+            % (table_name, order), (start_ts, end_ts))
+        rows.append(cursor.fetchone())
+    return rows
+
+
+def sqlite_get_last_row(cursor, table_name):
+    cursor.execute('SELECT id, ts, temperature FROM %s ORDER BY ts DESC LIMIT 1' % table_name)
+    return cursor.fetchone()
+
+
+def sqlite_get_last_two_rows(cursor, table_name):
+    cursor.execute('SELECT id, ts, temperature FROM %s ORDER BY ts DESC LIMIT 2' % table_name)
+    return cursor.fetchall()
+
+
+def highest_and_lowest_temperature(cursor, table_name, start_datetime, end_datetime, average_minutes):
+
+    min_temperature_sqlite_row, max_temperature_sqlite_row = sqlite_get_min_and_max_rows_between_ts(
+        cursor,
+        table_name,
+        helpers.datetime_to_utc_string_datetime(start_datetime),
+        helpers.datetime_to_utc_string_datetime(end_datetime))
+
+    if not min_temperature_sqlite_row:
+        return [[]] * 2
+
+    min_row_average = average(cursor, table_name, min_temperature_sqlite_row[1], average_minutes)
+    max_row_average = average(cursor, table_name, max_temperature_sqlite_row[1], average_minutes)
+
+    min_temperature_sqlite_row += (min_row_average,)
+    max_temperature_sqlite_row += (max_row_average,)
+
+    if min_temperature_sqlite_row[1] > max_temperature_sqlite_row[1]:
+        return min_temperature_sqlite_row, max_temperature_sqlite_row
+    else:
+        return max_temperature_sqlite_row, min_temperature_sqlite_row
+
+
+def sqlite_rows_for_time_range(cursor, table_name, start_datetime, hours, average_minutes):
+    end_datetime = start_datetime
+    start_datetime = end_datetime.shift(hours=-hours)
+    min_max_rows = highest_and_lowest_temperature(cursor, table_name, start_datetime, end_datetime, average_minutes)
+    return start_datetime, min_max_rows[0], min_max_rows[1]
+
+
+def average(cursor, table_name, sqlite_ts, average_minutes):
+    utc_aware = arrow.get(sqlite_ts).shift(minutes=-average_minutes)
+
+    count, _, _, total = sqlite_get_stats_between_ts(
+        cursor,
+        table_name,
+        helpers.datetime_to_utc_string_datetime(utc_aware),
+        sqlite_ts)
+
+    return helpers.decimal_round(Decimal(total) / Decimal(count), decimals=2)
+
+
+def bucket_stats(cursor, table_name, start_datetime, end_datetime):
+    """Count, lowest, highest and average temperature of rows in (start_datetime, end_datetime]."""
+
+    count, lowest, highest, total = sqlite_get_stats_between_ts(
+        cursor,
+        table_name,
+        helpers.datetime_to_utc_string_datetime(start_datetime),
+        helpers.datetime_to_utc_string_datetime(end_datetime))
+
+    if not count:
+        return 0, None, None, None
+
+    return count, lowest, highest, helpers.decimal_round(Decimal(total) / Decimal(count), decimals=2)
+
+
+def series(cursor, table_name, end_datetime, hours, num_of_buckets):
+    """Bucket stats going back from end_datetime, newest first, in the same way as sqlite_rows_for_time_range."""
+
+    start_datetime = end_datetime
+
+    for _ in range(num_of_buckets):
+        end_datetime = start_datetime
+        start_datetime = end_datetime.shift(hours=-hours)
+        yield (start_datetime, end_datetime) + bucket_stats(cursor, table_name, start_datetime, end_datetime)
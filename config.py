@@ -0,0 +1,302 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+import os
+import re
+from collections import namedtuple
+
+import yaml
+
+import helpers
+
+# Bump when the compiled form changes so that old cache files are not used
+COMPILED_VERSION = 2
+
+# Table names are used in sql statements as they are
+TABLE_NAME_PATTERN = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+DEFAULT_READINGS = 5
+DEFAULT_AVERAGE_MINUTES = 1440
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_REQUESTS_PER_100_SECONDS = 90
+
+Config = namedtuple('Config', 'sensors sheet_targets max_workers max_requests_per_100_seconds storage_root_url '
+                               'backup_folder_id')
+
+Sensor = namedtuple('Sensor', 'name device_id disallow_zero readings file_name table_name alerts sheet aws')
+
+Alert = namedtuple('Alert', 'title addresses if_what if_gt if_lt throttle')
+
+SheetTarget = namedtuple('SheetTarget', 'file_name table_name sheet_key sheet_name average_minutes')
+
+_loaded = {}
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def get(data, key, where, required=False, default=None):
+    value = data.get(key)
+
+    if value is None:
+        if required:
+            raise ConfigError('%s: "%s" is required.' % (where, key))
+        return default
+
+    return value
+
+
+def check_mapping(data, where):
+    if not isinstance(data, dict):
+        raise ConfigError('%s: expected a mapping, got %r.' % (where, data))
+    return data
+
+
+def get_mapping(data, key, where):
+    return check_mapping(get(data, key, where, default={}), '%s: "%s"' % (where, key))
+
+
+def get_list(data, key, where):
+    value = get(data, key, where, default=[])
+
+    if not isinstance(value, list):
+        raise ConfigError('%s: "%s" must be a list, got %r.' % (where, key, value))
+
+    return value
+
+
+def get_number(data, key, where, convert, required=False, default=None):
+    value = get(data, key, where, required=required, default=default)
+
+    if value is None:
+        return None
+
+    # bool is an int, but "if_gt: yes" is a mistake
+    if isinstance(value, bool):
+        raise ConfigError('%s: "%s" must be a number, got %r.' % (where, key, value))
+
+    try:
+        return convert(value)
+    except (TypeError, ValueError):
+        raise ConfigError('%s: "%s" must be a number, got %r.' % (where, key, value))
+
+
+def valid_table_name(table_name):
+    try:
+        return bool(TABLE_NAME_PATTERN.match(table_name))
+    except TypeError:
+        return False
+
+
+def compile_alert(data, sensor_name, where):
+    check_mapping(data, where)
+
+    addresses = get(data, 'addresses', where, required=True)
+
+    if not isinstance(addresses, list):
+        addresses = [addresses]
+
+    return Alert(
+        title=get(data, 'title', where, default=sensor_name),
+        addresses=addresses,
+        if_what=get(data, 'if_what', where, default='temperature'),
+        if_gt=get_number(data, 'if_gt', where, float),
+        if_lt=get_number(data, 'if_lt', where, float),
+        throttle=get_number(data, 'throttle', where, int, default=0),
+    )
+
+
+def compile_sheet(data, file_name, table_name, sheet_name, where):
+    check_mapping(data, where)
+
+    return SheetTarget(
+        file_name=get(data, 'file_name', where, default=file_name),
+        table_name=get(data, 'table_name', where, default=table_name),
+        sheet_key=get(data, 'sheet_key', where, required=True),
+        sheet_name=get(data, 'sheet_name', where, default=sheet_name),
+        average_minutes=get_number(data, 'average_minutes', where, int, default=DEFAULT_AVERAGE_MINUTES),
+    )
+
+
+def compile_sensor(data, storage_file_name, where):
+    check_mapping(data, where)
+
+    name = get(data, 'name', where, required=True)
+
+    if isinstance(name, (dict, list)):
+        raise ConfigError('%s: "name" must be a string, got %r.' % (where, name))
+
+    where = '%s "%s"' % (where, name)
+
+    file_name = get(data, 'file_name', where, default=storage_file_name)
+    table_name = get(data, 'table_name', where, default=name)
+
+    if not file_name:
+        raise ConfigError('%s: "file_name" is required when storage has no file_name.' % where)
+
+    if not valid_table_name(table_name):
+        raise ConfigError('%s: invalid table name "%s".' % (where, table_name))
+
+    sheet = get(data, 'sheet', where)
+
+    return Sensor(
+        name=name,
+        device_id=get(data, 'device_id', where),
+        disallow_zero=bool(get(data, 'disallow_zero', where, default=False)),
+        readings=get_number(data, 'readings', where, int, default=DEFAULT_READINGS),
+        file_name=file_name,
+        table_name=table_name,
+        alerts=[compile_alert(alert, name, '%s alert %d' % (where, i + 1))
+                for i, alert in enumerate(get_list(data, 'alerts', where))],
+        sheet=compile_sheet(sheet, file_name, table_name, name, '%s sheet' % where) if sheet else None,
+        aws=bool(get(data, 'aws', where, default=False)),
+    )
+
+
+def compile_config(data, file_name):
+
+    if not isinstance(data, dict):
+        raise ConfigError('%s: expected a mapping.' % file_name)
+
+    storage = get_mapping(data, 'storage', file_name)
+    sheets = get_mapping(data, 'sheets', file_name)
+    aws = get_mapping(data, 'aws', file_name)
+    backup = get_mapping(data, 'backup', file_name)
+
+    sensors = [compile_sensor(sensor, storage.get('file_name'), '%s: sensor %d' % (file_name, i + 1))
+               for i, sensor in enumerate(get_list(data, 'sensors', file_name))]
+
+    names = [sensor.name for sensor in sensors]
+    for name in set(names):
+        if names.count(name) > 1:
+            raise ConfigError('%s: sensor name "%s" is used more than once.' % (file_name, name))
+
+    if len(sensors) > 1 and not all(sensor.device_id for sensor in sensors):
+        raise ConfigError('%s: "device_id" is required for every sensor when there are many sensors.' % file_name)
+
+    # Sheets without a sensor of their own, for example tables written by other scripts
+    sheet_targets = [sensor.sheet for sensor in sensors if sensor.sheet] + [
+        compile_sheet(target, storage.get('file_name'), None, None, '%s: sheet target %d' % (file_name, i + 1))
+        for i, target in enumerate(get_list(sheets, 'targets', '%s: sheets' % file_name))]
+
+    for target in sheet_targets:
+        if not target.file_name or not target.table_name or not target.sheet_name:
+            raise ConfigError('%s: sheet target of "%s" needs file_name, table_name and sheet_name.'
+                              % (file_name, target.sheet_key))
+        if not valid_table_name(target.table_name):
+            raise ConfigError('%s: invalid table name "%s".' % (file_name, target.table_name))
+
+    return Config(
+        sensors=sensors,
+        sheet_targets=sheet_targets,
+        max_workers=get_number(sheets, 'max_workers', '%s: sheets' % file_name, int, default=DEFAULT_MAX_WORKERS),
+        max_requests_per_100_seconds=get_number(sheets, 'max_requests_per_100_seconds', '%s: sheets' % file_name,
+                                                int, default=DEFAULT_MAX_REQUESTS_PER_100_SECONDS),
+        storage_root_url=get(aws, 'storage_root_url', file_name),
+        backup_folder_id=get(backup, 'folder_id', file_name),
+    )
+
+
+def config_from_json(data):
+    # Namedtuples are saved as lists
+    sensors = []
+
+    for sensor in data[0]:
+        sensor = Sensor(*sensor)
+        sensors.append(sensor._replace(
+            alerts=[Alert(*alert) for alert in sensor.alerts],
+            sheet=SheetTarget(*sensor.sheet) if sensor.sheet else None))
+
+    return Config(*data)._replace(
+        sensors=sensors,
+        sheet_targets=[SheetTarget(*target) for target in data[1]])
+
+
+def compiled_cache_file_name(file_name):
+    directory, base_name = os.path.split(os.path.abspath(file_name))
+    return os.path.join(directory, '.%s.compiled.json' % base_name)
+
+
+def load(file_name):
+    """
+    Parse, validate and compile the config file. The result is cached in the process and, in
+    compiled form, next to the config file until the file changes.
+    """
+
+    stat = os.stat(file_name)
+    version = [COMPILED_VERSION, stat.st_mtime, stat.st_size]
+
+    loaded = _loaded.get(file_name)
+    if loaded and loaded[0] == version:
+        return loaded[1]
+
+    cache_file_name = compiled_cache_file_name(file_name)
+
+    try:
+        with open(cache_file_name) as f:
+            cache = json.load(f)
+        config = config_from_json(cache['config']) if cache['version'] == version else None
+    except (IOError, ValueError, KeyError, TypeError):
+        config = None
+
+    if config is None:
+        with open(file_name) as f:
+            config = compile_config(yaml.safe_load(f), file_name)
+
+        try:
+            with open(cache_file_name, 'w') as f:
+                json.dump({'version': version, 'config': config}, f)
+        except IOError:
+            pass
+
+    _loaded[file_name] = (version, config)
+
+    return config
+
+
+def find_sensor(config, name):
+    """The sensor with the name. The name can be left out if there is only one sensor."""
+
+    if name is None:
+        if len(config.sensors) != 1:
+            raise ConfigError('Sensor name is required when the config has %d sensors.' % len(config.sensors))
+        return config.sensors[0]
+
+    for sensor in config.sensors:
+        if sensor.name == name:
+            return sensor
+
+    raise ConfigError('No sensor named "%s" in the config.' % name)
+
+
+def file_names(config):
+    """Sqlite files of all sensors and sheet targets in order of appearance."""
+
+    names = []
+
+    for file_name, _ in tables(config):
+        if file_name not in names:
+            names.append(file_name)
+
+    return names
+
+
+def tables(config):
+    """(file_name, table_name) of all sensors and sheet targets in order of appearance."""
+
+    result = []
+
+    for table in [(sensor.file_name, sensor.table_name) for sensor in config.sensors] + [
+            (target.file_name, target.table_name) for target in config.sheet_targets]:
+        if table not in result:
+            result.append(table)
+
+    return result
+
+
+def apply(config):
+    """Settings that the config file overrides from .env."""
+    if config.storage_root_url:
+        helpers.STORAGE_ROOT_URL = config.storage_root_url
@@ -6,25 +6,41 @@ import os
 import httplib2
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
-from retry.api import retry
+
+import config
+import metrics
+import retry_policy
 
 
 def main():
 
     parser = argparse.ArgumentParser(description='Copy a file to Google Drive.')
     parser.add_argument('--file-name', type=str, required=True, help='File name to copy.')
-    parser.add_argument('--folder-id', type=str, default='root',
-                        help='Google Drive folder ID to copy file to. Defaults to "root".')
+    parser.add_argument('--folder-id', type=str,
+                        help='Google Drive folder ID to copy file to. Defaults to backup folder_id of --config, '
+                             'or "root".')
+    parser.add_argument('--config', type=str, help='Sensor config file.')
     args = parser.parse_args()
 
+    folder_id = args.folder_id
+
+    if not folder_id and args.config:
+        folder_id = config.load(args.config).backup_folder_id
+
+    metrics.configure('copy_file_to_drive')
+
     try:
-        upload_file(args.folder_id, args.file_name)
-    except (httplib.HTTPException, httplib2.HttpLib2Error):
+        upload_file(folder_id or 'root', args.file_name)
+    except (httplib.HTTPException, httplib2.HttpLib2Error, retry_policy.CircuitOpenError):
         pass
 
 
-@retry(tries=10, delay=30)
+@retry_policy.gdrive
+@metrics.timed('drive_upload')
 def upload_file(folder_id, file_name):
+    metrics.inc('drive_upload_attempts_total')
+    # PyDrive opens new httplib2 connections on every attempt
+    retry_policy.set_socket_timeout(retry_policy.gdrive)
     gauth = GoogleAuth(settings_file='pydrive_settings.yaml')
     gauth.CommandLineAuth()
     drive = GoogleDrive(gauth)
@@ -0,0 +1,245 @@
+# coding=utf-8
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+import config
+import helpers
+import metrics
+from aggregates import sqlite_get_table_names, sqlite_iter_rows
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger('export')
+handler = logging.FileHandler('export.log')
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s: %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+logger.info('----- START -----')
+
+COLUMNS = ['ts', 'local_ts', 'temperature']
+
+
+class CsvWriter(object):
+
+    extension = 'csv'
+
+    def __init__(self, file_name):
+        if sys.version_info.major < 3:
+            self.f = open(file_name, 'wb')
+        else:
+            self.f = io.open(file_name, 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.f.close()
+
+
+class ArrowWriter(object):
+    """Writes every batch as its own record batch / row group, so memory use does not grow with the table."""
+
+    extension = 'arrow'
+
+    def __init__(self, file_name):
+        self.schema = pyarrow.schema([
+            ('ts', pyarrow.string()),
+            ('local_ts', pyarrow.string()),
+            ('temperature', pyarrow.float64()),
+        ])
+        self.writer = self.open(file_name)
+
+    def open(self, file_name):
+        return pyarrow.ipc.new_file(file_name, self.schema)
+
+    def write(self, rows):
+        columns = list(zip(*rows))
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(columns[0]), pyarrow.array(columns[1]), pyarrow.array(columns[2], pyarrow.float64())],
+            schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class ParquetWriter(ArrowWriter):
+
+    extension = 'parquet'
+
+    def open(self, file_name):
+        return pyarrow.parquet.ParquetWriter(file_name, self.schema)
+
+
+WRITERS = {
+    'csv': CsvWriter,
+    'arrow': ArrowWriter,
+    'parquet': ParquetWriter,
+}
+
+
+def load_state(file_name):
+    try:
+        with open(file_name) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def save_state(file_name, state):
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(tmp_file_name, file_name)
+
+
+def existing_table_names(file_name):
+    if not os.path.exists(file_name):
+        return []
+
+    conn = sqlite3.connect(file_name)
+    try:
+        return sqlite_get_table_names(conn.cursor())
+    finally:
+        conn.close()
+
+
+def export_table(cursor, table_name, writer_class, file_name, start_ts, end_ts, batch_size):
+    """
+    Write rows of the table after start_ts up to end_ts to file_name. Returns the number of rows
+    and the last exported ts. The file is not created if there are no rows.
+    """
+
+    tmp_file_name = file_name + '.tmp'
+    writer = None
+    count = 0
+    last_ts = None
+
+    try:
+        for sqlite_rows in sqlite_iter_rows(cursor, table_name, start_ts, end_ts, batch_size):
+            if writer is None:
+                writer = writer_class(tmp_file_name)
+
+            with metrics.span('export_write', table=table_name):
+                writer.write([
+                    (row[0], helpers.utc_string_datetime_to_local_string_datetime(row[0]), row[1])
+                    for row in sqlite_rows
+                ])
+
+            count += len(sqlite_rows)
+            last_ts = sqlite_rows[-1][0]
+    finally:
+        if writer is not None:
+            writer.close()
+
+    if writer is not None:
+        os.rename(tmp_file_name, file_name)
+        metrics.inc('rows_exported_total', count, table=table_name)
+
+    return count, last_ts
+
+
+@helpers.exception(logger=logger)
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Export sqlite tables to CSV, Parquet or Arrow files.')
+
+    parser.add_argument('--config', type=str,
+                        help='Sensor config file. Exports the tables of all sensors and sheet targets. '
+                             'Replaces --file-name and --table-name.')
+    parser.add_argument('--file-name', type=str, help='Sqlite database file name.')
+    parser.add_argument('--table-name', type=str, action='append',
+                        help='Table to export. --table-name can be given multiple times. Defaults to all tables.')
+    parser.add_argument('--format', type=str, choices=sorted(WRITERS), default='csv',
+                        help='Output format. Parquet and Arrow need pyarrow. Defaults to csv.')
+    parser.add_argument('--output-dir', type=str, default='.', help='Directory to write files to. Defaults to ".".')
+    parser.add_argument('--since', type=str,
+                        help='Export rows after this time. ISO 8601, local time if no offset is given.')
+    parser.add_argument('--until', type=str,
+                        help='Export rows up to this time. ISO 8601, local time if no offset is given.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Export only rows after the last exported row. Every run writes a new file.')
+    parser.add_argument('--state-file', type=str, default='export_state.json',
+                        help='File to save the last exported ts to. Defaults to "export_state.json".')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Rows per batch. Defaults to 1000.')
+
+    args = parser.parse_args()
+
+    if not args.config and not args.file_name:
+        parser.error('Either --config or --file-name is required.')
+
+    if args.format != 'csv' and pyarrow is None:
+        parser.error('--format %s needs pyarrow: pip install pyarrow' % args.format)
+
+    metrics.configure('export')
+
+    writer_class = WRITERS[args.format]
+
+    start_ts = helpers.local_string_datetime_to_utc_string_datetime(args.since) if args.since else None
+    end_ts = helpers.local_string_datetime_to_utc_string_datetime(args.until) if args.until else None
+
+    state = load_state(args.state_file) if args.incremental else {}
+
+    if args.config:
+        tables = []
+        table_names = {}
+        # Tables of sensors that have not been read yet don't exist
+        for file_name, table_name in config.tables(config.load(args.config)):
+            if file_name not in table_names:
+                table_names[file_name] = existing_table_names(file_name)
+            if table_name in table_names[file_name]:
+                tables.append((file_name, table_name))
+            else:
+                logger.warning('No table %s in %s. Skipping.', table_name, file_name)
+    else:
+        conn = sqlite3.connect(args.file_name)
+        tables = [(args.file_name, table_name)
+                  for table_name in args.table_name or sqlite_get_table_names(conn.cursor())]
+        conn.close()
+
+    for file_name, table_name in tables:
+        conn = sqlite3.connect(file_name)
+        cursor = conn.cursor()
+
+        key = '%s:%s' % (file_name, table_name)
+        table_start_ts = start_ts
+
+        if args.incremental:
+            if state.get(key) and (not table_start_ts or state[key] > table_start_ts):
+                table_start_ts = state[key]
+            suffix = '-' + helpers.get_now().strftime('%Y%m%dT%H%M%S')
+        else:
+            suffix = ''
+
+        output_file_name = os.path.join(args.output_dir, '%s%s.%s' % (table_name, suffix, writer_class.extension))
+
+        count, last_ts = export_table(
+            cursor, table_name, writer_class, output_file_name, table_start_ts, end_ts, args.batch_size)
+
+        conn.close()
+
+        logger.info('Exported %d rows of %s to %s', count, table_name, output_file_name)
+
+        if args.incremental and last_ts:
+            state[key] = last_ts
+            save_state(args.state_file, state)
+
+    logger.info('-----  END  -----')
+
+
+if __name__ == '__main__':
+    main()
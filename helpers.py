@@ -17,16 +17,30 @@ import pytz
 # Create .env file path.
 dotenv_path = join(dirname(__file__), '.env')
 
-# Load file from the path.
-load_dotenv(dotenv_path)
+_env_loaded = False
 
-
-STORAGE_ROOT_URL = os.getenv('STORAGE_ROOT_URL')
+# Set by config.apply(). Otherwise STORAGE_ROOT_URL of .env is used.
+STORAGE_ROOT_URL = None
 
 
 TARGET_TIMEZONE = 'Europe/Helsinki'
 
 
+def getenv(name, default=None):
+    """Like os.getenv, but reads .env on first use. Variables already in the environment win."""
+    global _env_loaded
+
+    if not _env_loaded:
+        load_dotenv(dotenv_path)
+        _env_loaded = True
+
+    return os.getenv(name, default)
+
+
+def storage_root_url():
+    return STORAGE_ROOT_URL or getenv('STORAGE_ROOT_URL')
+
+
 def get_now():
     return datetime.datetime.utcnow().replace(tzinfo=pytz.utc, microsecond=0)
 
@@ -42,6 +56,21 @@ def utc_string_datetime_to_local_arrow(utc_string_datetime):
     return local_aware
 
 
+def datetime_to_utc_string_datetime(utc_aware):
+    return utc_aware.to('utc').format('YYYY-MM-DDTHH:mm:ssZZ')  # 2016-09-21T08:50:28+00:00
+
+
+def local_string_datetime_to_utc_string_datetime(string_datetime):
+    # Local time unless the string has an offset. arrow.get(..., tzinfo=) would override the offset.
+    parsed = arrow.parser.DateTimeParser().parse_iso(string_datetime)
+    aware = arrow.get(parsed)
+
+    if parsed.tzinfo is None:
+        aware = aware.replace(tzinfo=TARGET_TIMEZONE)
+
+    return datetime_to_utc_string_datetime(aware)
+
+
 def decimal_round(value, decimals=1):
 
     if not isinstance(value, Decimal):
@@ -0,0 +1,311 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import atexit
+import fcntl
+import io
+import json
+import os
+import re
+import threading
+import time
+from functools import wraps
+
+import helpers
+
+
+# Metrics are written only when METRICS_DIR is set (in the environment or .env).
+# METRICS_FORMAT 'prometheus' writes <job>.prom for the node_exporter textfile collector,
+# 'json' appends one line per run to <job>.jsonl.
+DEFAULT_METRICS_FORMAT = 'prometheus'
+
+METRIC_PREFIX = 'raspberry_sensors_'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300)  # Seconds
+
+MAX_SPANS = 1000
+
+_registry = None
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.bucket_counts[i] += 1
+
+
+class Span(object):
+
+    def __init__(self, registry, name, labels):
+        self.registry = registry
+        self.name = name
+        self.labels = labels
+        self.parent = None
+        self.start = None
+
+    def __enter__(self):
+        stack = self.registry.span_stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+        self.registry.span_stack().pop()
+        self.registry.end_span(self, duration, exc_type is not None)
+        return False
+
+
+class NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Registry(object):
+
+    def __init__(self, job, directory, output_format):
+        self.job = job
+        self.directory = directory
+        self.output_format = output_format
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def span_stack(self):
+        try:
+            return self.local.stack
+        except AttributeError:
+            self.local.stack = []
+            return self.local.stack
+
+    def inc(self, name, value, labels):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def end_span(self, span, duration, failed):
+        self.observe(span.name + '_seconds', duration, span.labels)
+        if failed:
+            self.inc(span.name + '_errors_total', 1, span.labels)
+        with self.lock:
+            if len(self.spans) < MAX_SPANS:
+                self.spans.append({
+                    'name': span.name,
+                    'labels': dict(span.labels),
+                    'parent': span.parent,
+                    'start': round(span.start, 4),
+                    'duration': round(duration, 4),
+                    'failed': failed,
+                })
+
+    def flush(self):
+        if self.output_format == 'json':
+            self.write_json()
+        else:
+            self.write_prometheus()
+
+    def write_json(self):
+        data = {
+            'job': self.job,
+            'ts': helpers.get_now().isoformat(),
+            'duration': round(time.time() - self.started, 4),
+            'counters': [
+                {'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in sorted(self.counters.items())
+            ],
+            'histograms': [
+                {'name': name, 'labels': dict(labels), 'count': h.count, 'sum': round(h.sum, 4)}
+                for (name, labels), h in sorted(self.histograms.items())
+            ],
+            'spans': self.spans,
+        }
+
+        file_name = os.path.join(self.directory, '%s.jsonl' % self.job)
+        with io.open(file_name, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(data, ensure_ascii=False) + '\n')
+
+    def write_prometheus(self):
+        # family -> (type, {series: value})
+        families = {}
+
+        def add(family, metric_type, series, value):
+            families.setdefault(family, (metric_type, {}))[1][series] = value
+
+        name = METRIC_PREFIX + 'last_run_timestamp_seconds'
+        add(name, 'gauge', name + self.format_labels(()), int(self.started))
+
+        name = METRIC_PREFIX + 'run_duration_seconds'
+        add(name, 'gauge', name + self.format_labels(()), time.time() - self.started)
+
+        for (name, labels), value in self.counters.items():
+            name = METRIC_PREFIX + sanitize_name(name)
+            add(name, 'counter', name + self.format_labels(labels), value)
+
+        for (name, labels), histogram in self.histograms.items():
+            name = METRIC_PREFIX + sanitize_name(name)
+            for upper_bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                add(name, 'histogram', name + '_bucket' + self.format_labels(labels + (('le', str(upper_bound)),)),
+                    count)
+            add(name, 'histogram', name + '_bucket' + self.format_labels(labels + (('le', '+Inf'),)), histogram.count)
+            add(name, 'histogram', name + '_sum' + self.format_labels(labels), histogram.sum)
+            add(name, 'histogram', name + '_count' + self.format_labels(labels), histogram.count)
+
+        file_name = os.path.join(self.directory, '%s.prom' % self.job)
+
+        # Processes of the same job can flush at the same time. Without the lock one of them could
+        # read the file before the other has renamed its version and its increments would be lost.
+        with open(file_name + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Every run is a new process, so counters and histograms continue from the previous file.
+                # Otherwise Prometheus would see a counter reset on every run.
+                for family, metric_type, series, value in read_prometheus(file_name):
+                    if metric_type in ('counter', 'histogram'):
+                        values = families.setdefault(family, (metric_type, {}))[1]
+                        values[series] = values.get(series, 0) + value
+
+                lines = []
+                for family in sorted(families):
+                    metric_type, values = families[family]
+                    lines.append('# TYPE %s %s' % (family, metric_type))
+                    for series in sorted(values):
+                        lines.append('%s %s' % (series, format_value(values[series])))
+
+                # Write and rename so that the collector never sees a half written file
+                tmp_file_name = '%s.%d.tmp' % (file_name, os.getpid())
+                with io.open(tmp_file_name, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(lines) + '\n')
+                os.rename(tmp_file_name, file_name)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def format_labels(self, labels):
+        labels = (('job', self.job),) + labels
+        return '{%s}' % ','.join(
+            '%s="%s"' % (sanitize_name(key), ('%s' % value).replace('\\', '\\\\').replace('"', '\\"'))
+            for key, value in labels)
+
+
+def read_prometheus(file_name):
+    """Yield (family, type, series, value) from a file written by write_prometheus."""
+
+    try:
+        with io.open(file_name, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return
+
+    family, metric_type = None, None
+
+    for line in lines:
+        if line.startswith('# TYPE '):
+            _, _, family, metric_type = line.split(' ', 3)
+        elif line and not line.startswith('#') and family:
+            series, _, value = line.rpartition(' ')
+            try:
+                yield family, metric_type, series, float(value)
+            except ValueError:
+                pass
+
+
+def format_value(value):
+    if value == int(value):
+        return '%d' % value
+    return '%.4f' % value
+
+
+def sanitize_name(name):
+    return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+
+def labels_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def configure(job, directory=None, output_format=None):
+    """Enable metrics for this process. Does nothing if no metrics directory is configured."""
+    global _registry
+
+    directory = directory or helpers.getenv('METRICS_DIR')
+
+    if not directory:
+        return
+
+    if _registry is None:
+        atexit.register(flush)
+
+    _registry = Registry(job, directory, output_format or helpers.getenv('METRICS_FORMAT', DEFAULT_METRICS_FORMAT))
+
+
+def enabled():
+    return _registry is not None
+
+
+def inc(name, value=1, **labels):
+    if _registry is None:
+        return
+    _registry.inc(name, value, labels_key(labels))
+
+
+def observe(name, value, **labels):
+    if _registry is None:
+        return
+    _registry.observe(name, value, labels_key(labels))
+
+
+def span(name, **labels):
+    """Context manager timing a stage. Records <name>_seconds histogram and a trace span."""
+    if _registry is None:
+        return NULL_SPAN
+    return Span(_registry, name, labels_key(labels))
+
+
+def timed(name=None, **labels):
+    def timed_inner(f):
+        span_name = name or f.__name__
+
+        @wraps(f)
+        def timed_wrap(*args, **kw):
+            if _registry is None:
+                return f(*args, **kw)
+            with span(span_name, **labels):
+                return f(*args, **kw)
+
+        return timed_wrap
+
+    return timed_inner
+
+
+def flush():
+    if _registry is None:
+        return
+    _registry.flush()
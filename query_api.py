@@ -0,0 +1,344 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from decimal import Decimal
+
+import arrow
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+
+import aggregates
+import config
+import helpers
+import metrics
+
+logger = logging.getLogger('query_api')
+handler = logging.FileHandler('query_api.log')
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s: %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+logger.info('----- START -----')
+
+MAX_BUCKETS = 1000
+MAX_RANGE_ROWS = 10000
+
+PATH_PATTERN = re.compile(r'^/tables(?:/(?P<table>[A-Za-z0-9_]+)/(?P<what>latest|range|series))?/?$')
+
+
+class QueryError(Exception):
+
+    def __init__(self, status, message):
+        super(QueryError, self).__init__(message)
+        self.status = status
+
+
+class TtlLruCache(object):
+    """
+    LRU cache whose entries expire after ttl seconds. Every entry is stored with the version of
+    the data it was computed from and is dropped when the version has changed.
+    """
+
+    def __init__(self, max_size=256, ttl=60, clock=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                return None
+
+            entry_version, expires, value = entry
+
+            if entry_version != version or expires < self.clock():
+                return None
+
+            # Move to the end as the most recently used
+            self.entries[key] = entry
+            return value
+
+    def put(self, key, version, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (version, self.clock() + self.ttl, value)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+def file_version(file_name):
+    # to_sqlite commits change the modification time and size of the database file
+    stat = os.stat(file_name)
+    return stat.st_mtime, stat.st_size
+
+
+def json_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError('%r is not JSON serializable' % value)
+
+
+def query_datetime(query, name, default):
+    values = query.get(name)
+
+    if not values:
+        return default
+
+    try:
+        return arrow.get(helpers.local_string_datetime_to_utc_string_datetime(values[0]))
+    except (ValueError, TypeError, arrow.parser.ParserError):
+        # A + in a query string means a space, so "+02:00" arrives as " 02:00"
+        raise QueryError(400, 'Invalid %s: %s. Send + as %%2B or use Z for UTC.' % (name, values[0]))
+
+
+def query_int(query, name, default):
+    values = query.get(name)
+
+    if not values:
+        return default
+
+    try:
+        return int(values[0])
+    except ValueError:
+        raise QueryError(400, 'Invalid %s: %s' % (name, values[0]))
+
+
+class QueryApi(object):
+    """Answers queries against the tables of the given sqlite files. Results are cached until a file changes."""
+
+    def __init__(self, file_names, cache):
+        self.file_names = file_names
+        self.cache = cache
+
+    def versions(self):
+        return tuple(file_version(file_name) for file_name in self.file_names)
+
+    def tables(self):
+        tables = {}
+
+        for file_name in self.file_names:
+            conn = sqlite3.connect(file_name)
+            try:
+                for row in conn.execute("SELECT name FROM sqlite_master WHERE type='table'"):
+                    if row[0] != 'sqlite_sequence':
+                        tables.setdefault(row[0], file_name)
+            finally:
+                conn.close()
+
+        return tables
+
+    def query(self, path, query_string):
+        """Return a JSON serializable result or raise QueryError."""
+
+        match = PATH_PATTERN.match(path)
+
+        if not match:
+            raise QueryError(404, 'Not found: %s' % path)
+
+        query = parse_qs(query_string)
+        key = (path, tuple(sorted((name, tuple(values)) for name, values in query.items())))
+        version = self.versions()
+
+        result = self.cache.get(key, version)
+
+        if result is not None:
+            metrics.inc('query_cache_hits_total')
+            return result
+
+        metrics.inc('query_cache_misses_total')
+
+        with metrics.span('query', what=match.group('what') or 'tables'):
+            result = self.compute(match.group('table'), match.group('what'), query)
+
+        self.cache.put(key, version, result)
+
+        return result
+
+    def compute(self, table_name, what, query):
+
+        tables = self.tables()
+
+        if table_name is None:
+            return {'tables': sorted(tables)}
+
+        if table_name not in tables:
+            raise QueryError(404, 'Unknown table: %s' % table_name)
+
+        conn = sqlite3.connect(tables[table_name])
+        try:
+            cursor = conn.cursor()
+
+            if what == 'latest':
+                return self.latest(cursor, table_name)
+            elif what == 'range':
+                return self.range(cursor, table_name, query)
+            else:
+                return self.series(cursor, table_name, query)
+        finally:
+            conn.close()
+
+    def latest(self, cursor, table_name):
+        row = aggregates.sqlite_get_last_row(cursor, table_name)
+
+        if not row:
+            return {'table': table_name, 'latest': None}
+
+        return {'table': table_name, 'latest': {'ts': row[1], 'temperature': row[2]}}
+
+    def range(self, cursor, table_name, query):
+        end_datetime = query_datetime(query, 'end', arrow.utcnow())
+        start_datetime = query_datetime(query, 'start', end_datetime.shift(days=-1))
+
+        rows = aggregates.sqlite_get_rows_between_ts(
+            cursor,
+            table_name,
+            helpers.datetime_to_utc_string_datetime(start_datetime),
+            helpers.datetime_to_utc_string_datetime(end_datetime),
+            # One extra row tells that the range is too large without reading all of it
+            limit=MAX_RANGE_ROWS + 1)
+
+        if len(rows) > MAX_RANGE_ROWS:
+            raise QueryError(400, 'Range has more than %d rows. Use series instead.' % MAX_RANGE_ROWS)
+
+        return {
+            'table': table_name,
+            'start': helpers.datetime_to_utc_string_datetime(start_datetime),
+            'end': helpers.datetime_to_utc_string_datetime(end_datetime),
+            'rows': [{'ts': row[1], 'temperature': row[2]} for row in rows],
+        }
+
+    def series(self, cursor, table_name, query):
+        end_datetime = query_datetime(query, 'end', arrow.utcnow())
+        start_datetime = query_datetime(query, 'start', end_datetime.shift(days=-1))
+        bucket_minutes = query_int(query, 'bucket_minutes', 60)
+
+        if bucket_minutes < 1:
+            raise QueryError(400, 'bucket_minutes must be positive.')
+
+        num_of_buckets = int((end_datetime - start_datetime).total_seconds() // (bucket_minutes * 60))
+
+        if num_of_buckets > MAX_BUCKETS:
+            raise QueryError(400, 'More than %d buckets. Use a larger bucket_minutes.' % MAX_BUCKETS)
+
+        buckets = [
+            {
+                'start': helpers.datetime_to_utc_string_datetime(bucket_start),
+                'end': helpers.datetime_to_utc_string_datetime(bucket_end),
+                'count': count,
+                'min': lowest,
+                'max': highest,
+                # Numbers like the temperatures of the other endpoints, not a Decimal string
+                'avg': float(avg) if avg is not None else None,
+            }
+            for bucket_start, bucket_end, count, lowest, highest, avg
+            in aggregates.series(cursor, table_name, end_datetime, bucket_minutes / 60.0, num_of_buckets)
+        ]
+
+        buckets.reverse()
+
+        return {'table': table_name, 'bucket_minutes': bucket_minutes, 'buckets': buckets}
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+
+        try:
+            status, result = 200, self.server.api.query(url.path, url.query)
+        except QueryError as e:
+            status, result = e.status, {'error': '%s' % e}
+        except (sqlite3.OperationalError, IOError, OSError) as e:
+            # Locked, missing or unreadable database file, likely to work again later
+            logger.warning('%s: %r', self.path, e)
+            status, result = 503, {'error': 'Database unavailable.'}
+        except sqlite3.Error as e:
+            logger.exception('%s: %r', self.path, e)
+            status, result = 500, {'error': 'Database error.'}
+
+        body = json.dumps(result, default=json_default).encode('utf-8')
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class QueryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, server_address, api):
+        HTTPServer.__init__(self, server_address, QueryRequestHandler)
+        self.api = api
+
+
+@helpers.exception(logger=logger)
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Serve latest values, ranges and min/max/avg series of sqlite tables over HTTP.')
+
+    parser.add_argument('--config', type=str,
+                        help='Sensor config file. Serves the files of all sensors and sheet targets too.')
+    parser.add_argument('--file-name', type=str, action='append',
+                        help='Sqlite database file name. --file-name can be given multiple times.')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen. Defaults to 127.0.0.1.')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen. Defaults to 8080.')
+    parser.add_argument('--cache-size', type=int, default=256, help='Number of cached results. Defaults to 256.')
+    parser.add_argument('--cache-ttl', type=int, default=60,
+                        help='Seconds to keep a cached result if the database has not changed. Defaults to 60.')
+
+    args = parser.parse_args()
+
+    file_names = list(args.file_name or [])
+
+    if args.config:
+        file_names += [file_name for file_name in config.file_names(config.load(args.config))
+                       if file_name not in file_names]
+
+    if not file_names:
+        parser.error('Either --config or --file-name is required.')
+
+    metrics.configure('query_api')
+
+    api = QueryApi(file_names, TtlLruCache(args.cache_size, args.cache_ttl))
+    server = QueryServer((args.host, args.port), api)
+
+    logger.info('Listening on %s:%d', args.host, args.port)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    server.server_close()
+    logger.info('-----  END  -----')
+
+
+if __name__ == '__main__':
+    main()
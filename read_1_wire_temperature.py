@@ -4,14 +4,18 @@ from __future__ import unicode_literals
 
 import argparse
 import glob
+import io
 import logging
 import os
 import random
 import time
+from array import array
 from decimal import Decimal
 
-from retry import retry
-
+import config
+import metrics
+import retry_policy
+import time_validity
 from helpers import decimal_round, get_now, print_dict_as_utf_8_json
 
 __author__ = 'Kimmo Ahola'
@@ -20,9 +24,21 @@ __version__ = '1.2'
 __email__ = 'kimmo.ahola@gmail.com'
 
 DEVICE_BASE_DIR = '/sys/bus/w1/devices/'
-RETRY_DELAY = 5  # Seconds
 DELAY_BETWEEN_READS = 7  # Seconds
 
+W1_SLAVE_MAX_SIZE = 128  # Bytes. The file is about 75 bytes.
+RING_BUFFER_SIZE = 16  # Samples per sensor
+
+SENSOR_INITIALIZING = 85000  # Power-on reset value
+MIN_MILLIDEGREES = -55000
+MAX_MILLIDEGREES = 125000
+
+CRC_OK = bytearray(b'YES')
+WHITESPACE = bytearray(b' \t\r\n')
+MINUS = ord('-')
+ZERO = ord('0')
+NINE = ord('9')
+
 
 logger = logging.getLogger('read_1_wire_temperature')
 handler = logging.FileHandler('read_1_wire_temperature.log')
@@ -33,41 +49,153 @@ logger.setLevel(logging.DEBUG)
 logger.info('----- START -----')
 
 
-def read_device_file(device_file_name):
-    with open(device_file_name, 'r') as f:
-        return f.readlines()
+class RingBuffer(object):
+    """Fixed size buffer of the latest raw samples (millidegrees) and their timestamps."""
 
+    def __init__(self, size):
+        self.values = array('i', [0]) * size
+        self.timestamps = [None] * size
+        # Ring indexes in value order, reused by median()
+        self.order = array('i', [0]) * size
+        self.size = size
+        self.count = 0
+        self.next = 0
 
-@retry(ValueError, tries=50, delay=RETRY_DELAY)
-def read_temp(device_file_name, disallow_zero):
+    def append(self, timestamp, value):
+        self.values[self.next] = value
+        self.timestamps[self.next] = timestamp
+        self.next = (self.next + 1) % self.size
+        self.count = min(self.count + 1, self.size)
 
-    lines = read_device_file(device_file_name)
+    def median(self, n):
+        """
+        Timestamp and value of the middle one (upper middle for even n) of the latest n samples.
+        Equal values keep their sample order, so the earlier sample comes first.
+        """
 
-    if not lines or len(lines) != 2 or not lines[0].strip().endswith('YES'):
-        raise ValueError()
+        n = min(n, self.count)
 
-    equals_pos = lines[1].find('t=')
+        if not n:
+            raise ValueError('No samples.')
 
-    if equals_pos == -1:
-        raise ValueError()
+        values = self.values
+        order = self.order
 
-    temp_string = lines[1][equals_pos+2:].strip()
+        # Insertion sort in place, n is at most a few dozen
+        for i in range(n):
+            index = (self.next - n + i) % self.size
+            value = values[index]
+            j = i
+            while j > 0 and values[order[j - 1]] > value:
+                order[j] = order[j - 1]
+                j -= 1
+            order[j] = index
 
-    if temp_string == '85000':
-        raise ValueError('Sensor initializing.')
+        middle = order[n // 2]
+        return self.timestamps[middle], values[middle]
+
+
+class Sensor(object):
+
+    def __init__(self, device_file_name, samples):
+        self.device_file_name = device_file_name
+        self.buffer = bytearray(W1_SLAVE_MAX_SIZE)
+        self.samples = RingBuffer(samples)
+
+
+sensors = {}
+
+
+def get_sensor(device_file_name, samples):
+    sensor = sensors.get(device_file_name)
+    if sensor is None or sensor.samples.size < samples:
+        sensor = sensors[device_file_name] = Sensor(device_file_name, max(samples, RING_BUFFER_SIZE))
+    return sensor
+
+
+# The 1-wire driver starts the temperature conversion when the file is read
+@metrics.timed('sensor_conversion')
+def read_device_file(device_file_name, buffer):
+    """Read the file into buffer. Returns the number of bytes read."""
+    with io.open(device_file_name, 'rb', buffering=0) as f:
+        return f.readinto(buffer) or 0
+
+
+def parse_w1_slave(buffer, length):
+    """
+    Millidegrees from w1_slave contents in buffer[:length]. The contents are two lines like
+
+        72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+        72 01 4b 46 7f ff 0e 10 57 t=23125
+
+    Raises ValueError if the CRC check failed or the contents are not valid.
+    """
+
+    newline = buffer.find(b'\n', 0, length)
+
+    if newline == -1:
+        raise ValueError('Incomplete device file.')
+
+    end = newline
+    while end > 0 and buffer[end - 1] in WHITESPACE:
+        end -= 1
 
-    temp_decimal = Decimal(temp_string) / Decimal(1000)
+    if end < 3 or buffer.find(CRC_OK, end - 3, end) == -1:
+        raise ValueError('CRC check failed.')
+
+    i = buffer.find(b't=', newline, length)
+
+    if i == -1:
+        raise ValueError('No temperature in device file.')
+
+    i += 2
+
+    negative = i < length and buffer[i] == MINUS
+    if negative:
+        i += 1
+
+    value = 0
+    start = i
+    while i < length and ZERO <= buffer[i] <= NINE:
+        value = value * 10 + buffer[i] - ZERO
+        i += 1
+
+    if i == start:
+        raise ValueError('No temperature in device file.')
+
+    while i < length and buffer[i] in WHITESPACE:
+        i += 1
+
+    if i != length:
+        raise ValueError('Unexpected data in device file.')
+
+    return -value if negative else value
+
+
+@retry_policy.sensor_read
+def read_raw_temp(sensor, disallow_zero):
+
+    metrics.inc('sensor_read_attempts_total')
+
+    length = read_device_file(sensor.device_file_name, sensor.buffer)
+
+    millidegrees = parse_w1_slave(sensor.buffer, length)
+
+    if millidegrees == SENSOR_INITIALIZING:
+        raise ValueError('Sensor initializing.')
 
     # Sometimes (rarely) zero means invalid, but sometimes it's a valid value
-    if temp_decimal < -55 or temp_decimal > 125 or disallow_zero and temp_decimal == 0:
-        raise ValueError('Temperature out of range. Was %s.' % temp_decimal)
+    if millidegrees < MIN_MILLIDEGREES or millidegrees > MAX_MILLIDEGREES or disallow_zero and millidegrees == 0:
+        raise ValueError('Temperature out of range. Was %s.' % (Decimal(millidegrees) / Decimal(1000)))
 
-    return get_now(), temp_decimal
+    return millidegrees
 
 
-@retry(ValueError, tries=6, delay=30)
+@retry_policy.time_sync
+@metrics.timed('time_check')
 def ensure_valid_time():
-    if os.system("(ntpq -pn | egrep '^\*') >/dev/null 2>&1") != 0:
+    metrics.inc('time_check_attempts_total')
+    if not time_validity.is_valid():
         raise ValueError('No valid time')
     return True
 
@@ -78,19 +206,17 @@ def read_n_and_take_middle_value(device_id, disallow_zero, n):
 
     ensure_valid_time()
 
-    readings = []
+    sensor = get_sensor(device_file_name, n)
 
     for i in range(n):
         if i > 0:
             # Sleep only between reads
             time.sleep(DELAY_BETWEEN_READS)
-        readings.append(read_temp(device_file_name, disallow_zero))
-
-    # Sort by temperature
-    readings = sorted(readings, key=lambda r: r[1])
+        sensor.samples.append(get_now(), read_raw_temp(sensor, disallow_zero))
 
     # Take the middle value
-    return readings[len(readings)//2]
+    timestamp, millidegrees = sensor.samples.median(n)
+    return timestamp, Decimal(millidegrees) / Decimal(1000)
 
 
 def simulate():
@@ -121,6 +247,9 @@ def main():
 
     parser = argparse.ArgumentParser(description='Read temperature from the 1-wire device file.')
 
+    parser.add_argument('--config', type=str,
+                        help='Sensor config file. Reads the sensor given by --sensor. Replaces the other arguments.')
+    parser.add_argument('--sensor', type=str, help='Name of the sensor in the config file. Not needed for one sensor.')
     parser.add_argument('--device-id', required=False, type=str, help='Device ID.')
     parser.add_argument('--simulate', required=False, action='store_true', help='Return random values for testing.')
     parser.add_argument('--disallow-zero', required=False, action='store_true',
@@ -128,11 +257,19 @@ def main():
 
     args = parser.parse_args()
 
+    device_id, disallow_zero, readings = args.device_id, args.disallow_zero, 5
+
+    if args.config:
+        sensor = config.find_sensor(config.load(args.config), args.sensor)
+        device_id, disallow_zero, readings = sensor.device_id, sensor.disallow_zero, sensor.readings
+
+    metrics.configure('read_1_wire_temperature')
+
     if args.simulate:
         stuff = simulate()
     else:
         try:
-            stuff = read_n_and_take_middle_value(args.device_id, args.disallow_zero, 5)
+            stuff = read_n_and_take_middle_value(device_id, disallow_zero, readings)
         except ValueError as e:
             logger.error(e)
             stuff = None
@@ -0,0 +1,251 @@
+# coding=utf-8
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import os
+import sqlite3
+
+import arrow
+
+import aggregates
+import config
+import helpers
+import metrics
+import send_email
+import to_aws
+import to_sqlite
+
+logger = logging.getLogger('replay')
+handler = logging.FileHandler('replay.log')
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s: %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+logger.info('----- START -----')
+
+
+class SqliteStage(object):
+
+    # Rows per batch the stage can take, None if any
+    max_batch_size = None
+
+    # Whether progress can be saved after each batch
+    checkpoint = True
+
+    def __init__(self, args):
+        self.file_name = args.target_file_name
+        self.table_name = args.target_table_name or args.table_name
+
+    def key(self):
+        return 'sqlite:%s:%s' % (self.file_name, self.table_name)
+
+    def process(self, rows):
+        to_sqlite.write_rows_to_sqlite(self.file_name, self.table_name, rows)
+
+    def close(self):
+        pass
+
+
+class AwsStage(object):
+
+    checkpoint = True
+
+    def __init__(self, args):
+        self.name = args.name or args.table_name
+        # Asked once, larger batches would be rejected by the storage
+        self.max_batch_size = to_aws.get_max_batch_size(self.name)
+
+    def key(self):
+        return 'aws:%s' % self.name
+
+    def process(self, rows):
+        to_aws.send_batch_to_aws(self.name, rows)
+
+    def close(self):
+        pass
+
+
+class EmailStage(object):
+    """
+    Runs the alert rules over the rows. Throttling is based on the row timestamps instead of the
+    wall clock. Alerts are printed, and sent as one digest email if addresses are given.
+
+    Progress is not saved: the digest is sent only at the end, so resuming from a checkpoint
+    would lose the alerts of an interrupted run. Run again over the same range instead.
+    """
+
+    max_batch_size = None
+
+    checkpoint = False
+
+    def __init__(self, args):
+        self.args = args
+        self.last_alert_ts = None
+        self.messages = []
+
+    def key(self):
+        return 'email:%s' % self.args.title
+
+    def throttled(self, ts):
+        if not self.args.throttle or self.last_alert_ts is None:
+            return False
+        return (arrow.get(ts) - self.last_alert_ts).total_seconds() / 60.0 < self.args.throttle
+
+    def process(self, rows):
+        for row in rows:
+            if self.throttled(row['ts']):
+                continue
+
+            message = send_email.alert_message(
+                self.args.title, self.args.if_what, self.args.if_gt, self.args.if_lt, row)
+
+            if message:
+                print(message)
+                self.messages.append(message)
+                self.last_alert_ts = arrow.get(row['ts'])
+
+    def close(self):
+        if self.messages and self.args.address:
+            send_email.email(self.args.address, 'Replayed alerts of %s' % self.args.title,
+                             '\n'.join(self.messages))
+
+
+def load_checkpoint(file_name, key):
+    try:
+        with open(file_name) as f:
+            return json.load(f).get(key)
+    except (IOError, ValueError):
+        return None
+
+
+def save_checkpoint(file_name, key, ts):
+    try:
+        with open(file_name) as f:
+            checkpoints = json.load(f)
+    except (IOError, ValueError):
+        checkpoints = {}
+
+    checkpoints[key] = ts
+
+    # Write and rename so that an interrupted write does not lose earlier checkpoints
+    tmp_file_name = file_name + '.tmp'
+    with open(tmp_file_name, 'w') as f:
+        json.dump(checkpoints, f, indent=2, sort_keys=True)
+    os.rename(tmp_file_name, file_name)
+
+
+def replay(cursor, table_name, stage, start_ts, end_ts, batch_size, checkpoint_file):
+
+    key = '%s:%s' % (table_name, stage.key())
+
+    if not stage.checkpoint:
+        checkpoint_file = None
+
+    if stage.max_batch_size and batch_size > stage.max_batch_size:
+        batch_size = stage.max_batch_size
+
+    checkpoint_ts = load_checkpoint(checkpoint_file, key) if checkpoint_file else None
+
+    if checkpoint_ts and (not start_ts or checkpoint_ts > start_ts):
+        logger.info('Resuming %s after %s', key, checkpoint_ts)
+        start_ts = checkpoint_ts
+
+    count = 0
+
+    for sqlite_rows in aggregates.sqlite_iter_rows(cursor, table_name, start_ts, end_ts, batch_size):
+        rows = [{'ts': row[0], 'temperature': str(row[1])} for row in sqlite_rows]
+
+        with metrics.span('replay_batch', stage=stage.__class__.__name__):
+            stage.process(rows)
+
+        count += len(rows)
+        metrics.inc('rows_replayed_total', len(rows), table=table_name)
+
+        if checkpoint_file:
+            save_checkpoint(checkpoint_file, key, rows[-1]['ts'])
+
+        logger.info('Replayed %d rows of %s up to %s', count, key, rows[-1]['ts'])
+
+    stage.close()
+
+    return count
+
+
+@helpers.exception(logger=logger)
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Replay rows of a sqlite table in ts order through a pipeline stage.')
+
+    parser.add_argument('--config', type=str,
+                        help='Sensor config file. Replays the table of the sensor given by --sensor. '
+                             'Replaces --file-name and --table-name.')
+    parser.add_argument('--sensor', type=str, help='Name of the sensor in the config file. Not needed for one sensor.')
+    parser.add_argument('--file-name', type=str, help='Sqlite database file name.')
+    parser.add_argument('--table-name', type=str, help='Sqlite database table name.')
+    parser.add_argument('--since', type=str,
+                        help='Replay rows after this time. ISO 8601, local time if no offset is given.')
+    parser.add_argument('--until', type=str,
+                        help='Replay rows up to this time. ISO 8601, local time if no offset is given.')
+    parser.add_argument('--batch-size', type=int, default=500, help='Rows per batch. Defaults to 500.')
+    parser.add_argument('--checkpoint-file', type=str, default='replay_checkpoint.json',
+                        help='File to save progress to. Defaults to "replay_checkpoint.json".')
+    parser.add_argument('--restart', action='store_true', help='Ignore saved progress and start from the beginning.')
+
+    subparsers = parser.add_subparsers(dest='stage')
+
+    sqlite_parser = subparsers.add_parser('sqlite', help='Write rows to another sqlite file.')
+    sqlite_parser.add_argument('--target-file-name', type=str, required=True, help='Target sqlite file name.')
+    sqlite_parser.add_argument('--target-table-name', type=str,
+                               help='Target table name. Defaults to --table-name.')
+    sqlite_parser.set_defaults(stage_class=SqliteStage)
+
+    aws_parser = subparsers.add_parser('aws', help='Send rows to AWS.')
+    aws_parser.add_argument('--name', type=str, help='Name of the sensor. Defaults to --table-name.')
+    aws_parser.set_defaults(stage_class=AwsStage)
+
+    email_parser = subparsers.add_parser('email', help='Run alert rules over rows.')
+    email_parser.add_argument('--title', type=str, required=True, help='Title of the alerts.')
+    email_parser.add_argument('--address', type=str, action='append',
+                              help='Send found alerts as one email to this address. Can be given multiple times.')
+    email_parser.add_argument('--if-what', type=str, required=True, help='Parameter name.')
+    email_parser.add_argument('--if-gt', type=float, help='Alert if parameter name is greater than a number.')
+    email_parser.add_argument('--if-lt', type=float, help='Alert if parameter name is lower than a number.')
+    email_parser.add_argument('--throttle', type=int, help='At most one alert per THROTTLE minutes of data.')
+    email_parser.set_defaults(stage_class=EmailStage)
+
+    args = parser.parse_args()
+
+    if args.config:
+        sensor_config = config.load(args.config)
+        config.apply(sensor_config)
+        sensor = config.find_sensor(sensor_config, args.sensor)
+        args.file_name, args.table_name = sensor.file_name, sensor.table_name
+    elif not args.file_name or not args.table_name:
+        parser.error('Either --config or both --file-name and --table-name are required.')
+
+    metrics.configure('replay')
+
+    stage = args.stage_class(args)
+
+    if args.restart and stage.checkpoint and os.path.exists(args.checkpoint_file):
+        save_checkpoint(args.checkpoint_file, '%s:%s' % (args.table_name, stage.key()), None)
+
+    conn = sqlite3.connect(args.file_name)
+    cursor = conn.cursor()
+
+    start_ts = helpers.local_string_datetime_to_utc_string_datetime(args.since) if args.since else None
+    end_ts = helpers.local_string_datetime_to_utc_string_datetime(args.until) if args.until else None
+
+    count = replay(cursor, args.table_name, stage, start_ts, end_ts, args.batch_size, args.checkpoint_file)
+
+    conn.close()
+
+    logger.info('Replayed %d rows', count)
+    logger.info('-----  END  -----')
+
+
+if __name__ == '__main__':
+    main()
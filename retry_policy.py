@@ -0,0 +1,197 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import random
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+from functools import wraps
+
+import metrics
+
+logger = logging.getLogger('retry_policy')
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Remembers consecutive failures of a target across processes in a state file. After
+    failure_threshold failed calls the circuit opens and calls are skipped until reset_timeout
+    seconds have passed. Then one trial call is let through and the timeout starts again, so other
+    calls keep being skipped until the trial succeeds. The state file is only a hint: if it can not
+    be written the breaker just stays closed.
+    """
+
+    def __init__(self, target, failure_threshold=3, reset_timeout=600, state_dir=None, clock=time.time):
+        self.target = target
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.file_name = os.path.join(state_dir or tempfile.gettempdir(), 'circuit-%s' % target)
+        self.clock = clock
+
+    def read_state(self):
+        try:
+            with open(self.file_name) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {'failures': 0, 'opened_at': None}
+
+    def write_state(self, state):
+        try:
+            with open(self.file_name, 'w') as f:
+                json.dump(state, f)
+        except (IOError, OSError) as e:
+            logger.warning('Could not write circuit state of %s: %r', self.target, e)
+
+    def allow(self):
+        state = self.read_state()
+
+        if state['failures'] < self.failure_threshold or state['opened_at'] is None:
+            return True
+
+        if self.clock() - state['opened_at'] < self.reset_timeout:
+            return False
+
+        # Half open: restart the timeout so that only this call tests the target
+        state['opened_at'] = self.clock()
+        self.write_state(state)
+        logger.info('Circuit of %s half open. Letting one trial call through.', self.target)
+        return True
+
+    def record_success(self):
+        try:
+            os.remove(self.file_name)
+        except (IOError, OSError):
+            pass
+
+    def record_failure(self):
+        state = self.read_state()
+        state['failures'] += 1
+        if state['failures'] >= self.failure_threshold:
+            state['opened_at'] = self.clock()
+            logger.warning('Circuit of %s opened after %d failures', self.target, state['failures'])
+        self.write_state(state)
+
+
+class RetryPolicy(object):
+    """
+    Retries a call on the given exceptions with exponential backoff and jitter. Gives up after
+    tries attempts or when the next sleep would exceed the deadline (seconds from the first
+    attempt), whichever comes first.
+
+    The deadline is only checked between attempts, so network calls must pass attempt_timeout()
+    as their timeout. It is at most timeout seconds and never past the deadline.
+    """
+
+    def __init__(self, stage, exceptions=Exception, tries=3, delay=1, max_delay=60, backoff=2, jitter=0.5,
+                 deadline=60, timeout=None, breaker=None, sleep=time.sleep, clock=time.time):
+        self.stage = stage
+        self.exceptions = exceptions
+        self.tries = tries
+        self.delay = delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.jitter = jitter
+        self.deadline = deadline
+        self.timeout = timeout
+        self.breaker = breaker
+        self.sleep = sleep
+        self.clock = clock
+        # Budget left for the attempt in progress, per thread
+        self.local = threading.local()
+
+    def __call__(self, f):
+        @wraps(f)
+        def retry_wrap(*args, **kw):
+            return self.call(f, *args, **kw)
+        return retry_wrap
+
+    def attempt_timeout(self):
+        """Seconds the current attempt may take. Outside a call just the per attempt timeout."""
+
+        remaining = getattr(self.local, 'remaining', None)
+
+        if remaining is None:
+            return self.timeout
+
+        if self.timeout is None:
+            return remaining
+
+        return min(self.timeout, remaining)
+
+    def pause(self, attempt):
+        pause = min(self.max_delay, self.delay * self.backoff ** (attempt - 1))
+        return pause * (1 - self.jitter * random.random())
+
+    def call(self, f, *args, **kw):
+
+        if self.breaker and not self.breaker.allow():
+            metrics.inc('circuit_open_total', stage=self.stage, target=self.breaker.target)
+            raise CircuitOpenError('Circuit of %s is open. Skipping %s.' % (self.breaker.target, self.stage))
+
+        start = self.clock()
+        attempt = 0
+
+        while True:
+            attempt += 1
+            try:
+                self.local.remaining = self.deadline - (self.clock() - start)
+                try:
+                    result = f(*args, **kw)
+                finally:
+                    self.local.remaining = None
+            except self.exceptions as e:
+                pause = self.pause(attempt)
+                elapsed = self.clock() - start
+
+                if attempt >= self.tries or elapsed + pause > self.deadline:
+                    metrics.inc('retry_gave_up_total', stage=self.stage)
+                    metrics.observe('retry_elapsed_seconds', elapsed, stage=self.stage)
+                    if self.breaker:
+                        self.breaker.record_failure()
+                    raise
+
+                logger.warning('%s failed (attempt %d): %r. Retrying in %.1f seconds.', self.stage, attempt, e, pause)
+                metrics.inc('retries_total', stage=self.stage)
+                metrics.observe('retry_sleep_seconds', pause, stage=self.stage)
+                self.sleep(pause)
+            else:
+                if self.breaker:
+                    self.breaker.record_success()
+                if attempt > 1:
+                    metrics.observe('retry_elapsed_seconds', self.clock() - start, stage=self.stage)
+                return result
+
+
+# Stage policies. Deadlines bound the worst case time a stage can keep a cron slot busy.
+
+sensor_read = RetryPolicy('sensor_read', ValueError, tries=20, delay=1, max_delay=5, deadline=60)
+
+time_sync = RetryPolicy('time_sync', ValueError, tries=6, delay=5, max_delay=30, deadline=120)
+
+# Only a locked or busy database is worth retrying
+sqlite_write = RetryPolicy('sqlite_write', sqlite3.OperationalError, tries=3, delay=2, max_delay=10, deadline=30)
+
+aws = RetryPolicy('aws', tries=10, delay=2, max_delay=30, deadline=120, timeout=20, breaker=CircuitBreaker('aws'))
+
+gsheets = RetryPolicy('gsheets', tries=3, delay=5, max_delay=30, deadline=120, timeout=60,
+                      breaker=CircuitBreaker('gsheets'))
+
+gdrive = RetryPolicy('gdrive', tries=5, delay=10, max_delay=60, deadline=300, timeout=120,
+                     breaker=CircuitBreaker('gdrive'))
+
+
+def set_socket_timeout(policy):
+    """
+    For clients that take no timeout argument, like the httplib2 based Google clients: sockets
+    opened from now on time out after the attempt timeout of the policy.
+    """
+    socket.setdefaulttimeout(policy.attempt_timeout())
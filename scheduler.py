@@ -0,0 +1,96 @@
+# coding=utf-8
+import argparse
+import logging
+from multiprocessing.pool import ThreadPool
+
+import config
+import helpers
+import metrics
+import read_1_wire_temperature
+import send_email
+import to_aws
+import to_sqlite
+
+logger = logging.getLogger('scheduler')
+handler = logging.FileHandler('scheduler.log')
+formatter = logging.Formatter('%(asctime)s %(levelname)s %(funcName)s: %(message)s')
+handler.setFormatter(formatter)
+logger.addHandler(handler)
+logger.setLevel(logging.DEBUG)
+logger.info('----- START -----')
+
+
+def read_sensor(sensor, simulate):
+    if simulate:
+        return read_1_wire_temperature.simulate()
+    return read_1_wire_temperature.read_n_and_take_middle_value(sensor.device_id, sensor.disallow_zero, sensor.readings)
+
+
+def run_sensor(sensor, simulate):
+    """Read a sensor, store the reading, check its alerts and send it to AWS. Same as the crontab pipe."""
+
+    try:
+        with metrics.span('sensor', sensor=sensor.name):
+            now, temperature = read_sensor(sensor, simulate)
+
+            data = {
+                'ts': now.isoformat(),
+                'temperature': str(temperature),
+            }
+
+            to_sqlite.write_to_sqlite(sensor.file_name, sensor.table_name, data)
+
+            for alert in sensor.alerts:
+                send_email.process_data(alert.addresses, alert.title, alert.if_what, alert.if_gt, alert.if_lt,
+                                        alert.throttle, data)
+
+            if sensor.aws:
+                to_aws.send_to_aws(sensor.table_name, data)
+
+        logger.info('%s: %s', sensor.name, data)
+        return True
+
+    # One failing sensor must not stop the others
+    # noinspection PyBroadException
+    except Exception as e:
+        logger.exception('%s: %r', sensor.name, e)
+        return False
+
+
+@helpers.exception(logger=logger)
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Read all sensors of the config file, write them to sqlite, send alerts and send to AWS.')
+
+    parser.add_argument('--config', type=str, required=True, help='Sensor config file.')
+    parser.add_argument('--sensor', type=str, action='append',
+                        help='Run only this sensor. --sensor can be given multiple times. Defaults to all sensors.')
+    parser.add_argument('--simulate', required=False, action='store_true', help='Use random values for testing.')
+
+    args = parser.parse_args()
+
+    sensor_config = config.load(args.config)
+    config.apply(sensor_config)
+
+    sensors = [sensor for sensor in sensor_config.sensors if not args.sensor or sensor.name in args.sensor]
+
+    if not sensors:
+        parser.error('No sensors to run.')
+
+    metrics.configure('scheduler')
+
+    # Reading a sensor is mostly waiting, so all sensors are read at the same time
+    pool = ThreadPool(len(sensors))
+    try:
+        results = pool.map(lambda sensor: run_sensor(sensor, args.simulate), sensors)
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info('%d of %d sensors succeeded', sum(results), len(sensors))
+    logger.info('-----  END  -----')
+
+
+if __name__ == '__main__':
+    main()
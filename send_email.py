@@ -12,7 +12,9 @@ from email.mime.text import MIMEText
 
 from slugify import slugify
 
+import config
 import helpers
+import metrics
 
 logger = logging.getLogger('send_email')
 handler = logging.FileHandler('send_email.log')
@@ -48,6 +50,15 @@ def process_data(addresses, title, if_what, if_gt, if_lt, throttle, data_in):
     if minutes_from_last_email(title) < throttle:
         return
 
+    message = alert_message(title, if_what, if_gt, if_lt, data_in)
+
+    if message:
+        email(addresses, 'Alert of %s' % title, message)
+        mark_last_email(title)
+
+
+def alert_message(title, if_what, if_gt, if_lt, data_in):
+
     message = ''
 
     timestamp = helpers.utc_string_datetime_to_local_string_datetime(data_in['ts'])
@@ -62,11 +73,10 @@ def process_data(addresses, title, if_what, if_gt, if_lt, throttle, data_in):
         # Always send message
         message = '%s\n\n%s %s: %s\n' % (timestamp, title, if_what, data_in[if_what])
 
-    if message:
-        email(addresses, 'Alert of %s' % title, message)
-        mark_last_email(title)
+    return message
 
 
+@metrics.timed('smtp_send')
 def send_email(address, mime_text):
     s = smtplib.SMTP('localhost')
     s.sendmail(address, [address], mime_text.as_string())
@@ -91,19 +101,33 @@ def main():
     parser = argparse.ArgumentParser(
         description='Read temperature and humidity from stdin and write them to sqlite file.')
 
-    parser.add_argument('--title', type=str, required=True, help='Title of the email.')
-    parser.add_argument('--address', type=str, required=True, action='append',
+    parser.add_argument('--config', type=str,
+                        help='Sensor config file. Checks the alerts of the sensor given by --sensor. '
+                             'Replaces the other arguments.')
+    parser.add_argument('--sensor', type=str, help='Name of the sensor in the config file. Not needed for one sensor.')
+    parser.add_argument('--title', type=str, help='Title of the email.')
+    parser.add_argument('--address', type=str, action='append',
                         help='Email address to send alerts. --address can be given multiple times.')
-    parser.add_argument('--if-what', type=str, required=True, help='Parameter name.')
+    parser.add_argument('--if-what', type=str, help='Parameter name.')
     parser.add_argument('--if-gt', type=float, help='Send email if parameter name is greater than a number.')
     parser.add_argument('--if-lt', type=float, help='Send email if parameter name is lower than a number.')
     parser.add_argument('--throttle', type=int, help='Send at most one email per THROTTLE minutes.')
 
     args = parser.parse_args()
 
+    if args.config:
+        alerts = config.find_sensor(config.load(args.config), args.sensor).alerts
+    elif args.title and args.address and args.if_what:
+        alerts = [config.Alert(args.title, args.address, args.if_what, args.if_gt, args.if_lt, args.throttle)]
+    else:
+        parser.error('Either --config or all of --title, --address and --if-what are required.')
+
+    metrics.configure('send_email')
+
     data_in = helpers.read_stdin()
 
-    process_data(args.address, args.title, args.if_what, args.if_gt, args.if_lt, args.throttle, data_in)
+    for alert in alerts:
+        process_data(alert.addresses, alert.title, alert.if_what, alert.if_gt, alert.if_lt, alert.throttle, data_in)
 
     data_out = json.dumps(data_in)
 
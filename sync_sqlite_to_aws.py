@@ -6,7 +6,10 @@ import sqlite3
 
 import requests
 
+import config
 import helpers
+import metrics
+import retry_policy
 
 logger = logging.getLogger('to_aws')
 handler = logging.FileHandler('to_aws.log')
@@ -17,40 +20,47 @@ logger.setLevel(logging.DEBUG)
 logger.info('----- START -----')
 
 
+@metrics.timed('sqlite_query')
 def sqlite_get_rows_after_ts(cursor, table_name, start_ts, limit):
     if start_ts:
         cursor.execute(
-            'SELECT ts, temperature FROM %s WHERE ts>? GROUP BY ts LIMIT ?' % table_name, (start_ts, str(limit)))
+            'SELECT ts, temperature FROM %s WHERE ts>? ORDER BY ts LIMIT ?' % table_name, (start_ts, limit))
     else:
         cursor.execute(
-            'SELECT ts, temperature FROM %s GROUP BY ts LIMIT ?' % table_name, (str(limit), ))
+            'SELECT ts, temperature FROM %s ORDER BY ts LIMIT ?' % table_name, (limit, ))
     return cursor.fetchall()
 
 
-def main():
+@retry_policy.aws
+def get_status(sensor_id):
+    with metrics.span('http_request', target='aws', endpoint='status'):
+        r = requests.get(helpers.storage_root_url() + 'status', params={'sensorId': sensor_id},
+                         timeout=retry_policy.aws.attempt_timeout())
+    r.raise_for_status()
+    return r
 
-    parser = argparse.ArgumentParser(
-        description='Sync sqlite to Google spreadsheet.')
 
-    parser.add_argument('--file-name', type=str, required=True, help='Sqlite database file name.')
-    parser.add_argument('--table-name', type=str, required=True, help='Sqlite database table name.')
+@retry_policy.aws
+def add_items(data):
+    with metrics.span('http_request', target='aws', endpoint='add'):
+        r = requests.post(helpers.storage_root_url() + 'add', data=json.dumps(data),
+                          timeout=retry_policy.aws.attempt_timeout())
+    r.raise_for_status()
 
-    args = parser.parse_args()
 
-    conn = sqlite3.connect(args.file_name)
-    cursor = conn.cursor()
+def sync_table(file_name, table_name):
 
-    logging.captureWarnings(True)
-    logging.getLogger().setLevel(logging.WARNING)
+    conn = sqlite3.connect(file_name)
+    cursor = conn.cursor()
 
-    sensor_id = args.table_name
+    sensor_id = table_name
 
-    r = requests.get(helpers.STORAGE_ROOT_URL + 'status', params={'sensorId': sensor_id})
+    r = get_status(sensor_id)
     if r.status_code == 200:
         j = r.json()
         latest_item_ts = j.get('latestItem').get('ts')
         max_batch = j['config']['maxAddBatchSize']
-        rows = sqlite_get_rows_after_ts(cursor, args.table_name, latest_item_ts, max_batch)
+        rows = sqlite_get_rows_after_ts(cursor, table_name, latest_item_ts, max_batch)
 
         if rows:
             data = {
@@ -62,9 +72,44 @@ def main():
                 ],
             }
 
-            requests.post(helpers.STORAGE_ROOT_URL + 'add', data=json.dumps(data))
+            add_items(data)
+            metrics.inc('rows_synced_total', len(rows), table=table_name)
 
     conn.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(
+        description='Sync sqlite to AWS.')
+
+    parser.add_argument('--config', type=str,
+                        help='Sensor config file. Syncs all sensors with aws enabled. Replaces the other arguments.')
+    parser.add_argument('--file-name', type=str, help='Sqlite database file name.')
+    parser.add_argument('--table-name', type=str, help='Sqlite database table name.')
+
+    args = parser.parse_args()
+
+    if args.config:
+        sensor_config = config.load(args.config)
+        config.apply(sensor_config)
+        tables = [(sensor.file_name, sensor.table_name) for sensor in sensor_config.sensors if sensor.aws]
+    elif args.file_name and args.table_name:
+        tables = [(args.file_name, args.table_name)]
+    else:
+        parser.error('Either --config or both --file-name and --table-name are required.')
+
+    metrics.configure('sync_sqlite_to_aws')
+
+    logging.captureWarnings(True)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    for file_name, table_name in tables:
+        try:
+            sync_table(file_name, table_name)
+        except (requests.RequestException, retry_policy.CircuitOpenError) as e:
+            logger.warning('Syncing %s failed: %r', table_name, e)
+
     logger.info('-----  END  -----')
 
 
@@ -0,0 +1,209 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+try:
+    from urllib2 import HTTPError, urlopen
+except ImportError:
+    from urllib.error import HTTPError
+    from urllib.request import urlopen
+
+import query_api
+from query_api import QueryApi, QueryError, QueryServer, TtlLruCache
+
+
+def create_fixture(file_name):
+    """Rows every 10 minutes from 2018-05-01T00:00 UTC, temperatures 0.5, 1.5, ... 11.5."""
+
+    conn = sqlite3.connect(file_name)
+    conn.execute('CREATE TABLE ilp_out (id INTEGER PRIMARY KEY AUTOINCREMENT, ts DATETIME NOT NULL, '
+                 'temperature DECIMAL(6,2) NOT NULL)')
+    conn.executemany('INSERT INTO ilp_out (ts, temperature) VALUES (?, ?)', [
+        ('2018-05-01T%02d:%02d:00+00:00' % (i // 6, i % 6 * 10), i + 0.5)
+        for i in range(12)
+    ])
+    conn.commit()
+    conn.close()
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class QueryApiTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'ilp_out.sqlite')
+        create_fixture(self.file_name)
+        self.api = QueryApi([self.file_name], TtlLruCache())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assertQueryError(self, status, path, query_string=''):
+        try:
+            self.api.query(path, query_string)
+        except QueryError as e:
+            self.assertEqual(e.status, status)
+        else:
+            self.fail('No QueryError for %s?%s' % (path, query_string))
+
+    def test_tables(self):
+        self.assertEqual(self.api.query('/tables', ''), {'tables': ['ilp_out']})
+
+    def test_latest(self):
+        self.assertEqual(self.api.query('/tables/ilp_out/latest', '')['latest'],
+                         {'ts': '2018-05-01T01:50:00+00:00', 'temperature': 11.5})
+
+    def test_range(self):
+        result = self.api.query('/tables/ilp_out/range', 'start=2018-05-01T00:00:00Z&end=2018-05-01T01:00:00%2B00:00')
+
+        self.assertEqual(result['start'], '2018-05-01T00:00:00+00:00')
+        self.assertEqual(result['end'], '2018-05-01T01:00:00+00:00')
+        # Start is exclusive, end inclusive
+        self.assertEqual([row['ts'] for row in result['rows']],
+                         ['2018-05-01T00:%02d:00+00:00' % minute for minute in (10, 20, 30, 40, 50)] +
+                         ['2018-05-01T01:00:00+00:00'])
+
+    def test_range_local_time(self):
+        # Europe/Helsinki is UTC+3 in May
+        result = self.api.query('/tables/ilp_out/range', 'start=2018-05-01T03:00:00&end=2018-05-01T03:30:00')
+        self.assertEqual(len(result['rows']), 3)
+
+    def test_range_too_large(self):
+        max_range_rows = query_api.MAX_RANGE_ROWS
+        query_api.MAX_RANGE_ROWS = 5
+        try:
+            self.assertQueryError(400, '/tables/ilp_out/range', 'start=2018-05-01T00:00:00Z&end=2018-05-01T01:00:00Z')
+        finally:
+            query_api.MAX_RANGE_ROWS = max_range_rows
+
+    def test_series(self):
+        result = self.api.query(
+            '/tables/ilp_out/series', 'start=2018-05-01T00:00:00Z&end=2018-05-01T02:00:00Z&bucket_minutes=60')
+
+        self.assertEqual(result['bucket_minutes'], 60)
+        self.assertEqual(result['buckets'], [
+            {'start': '2018-05-01T00:00:00+00:00', 'end': '2018-05-01T01:00:00+00:00',
+             'count': 6, 'min': 1.5, 'max': 6.5, 'avg': 4.0},
+            {'start': '2018-05-01T01:00:00+00:00', 'end': '2018-05-01T02:00:00+00:00',
+             'count': 5, 'min': 7.5, 'max': 11.5, 'avg': 9.5},
+        ])
+
+    def test_series_empty_bucket(self):
+        result = self.api.query(
+            '/tables/ilp_out/series', 'start=2018-05-01T02:00:00Z&end=2018-05-01T03:00:00Z&bucket_minutes=60')
+
+        self.assertEqual(result['buckets'][0]['count'], 0)
+        self.assertEqual(result['buckets'][0]['avg'], None)
+
+    def test_bad_requests(self):
+        self.assertQueryError(400, '/tables/ilp_out/range', 'start=yesterday')
+        # An unescaped + is a space
+        self.assertQueryError(400, '/tables/ilp_out/range', 'start=2018-05-01T00:00:00+00:00')
+        self.assertQueryError(400, '/tables/ilp_out/series', 'bucket_minutes=abc')
+        self.assertQueryError(400, '/tables/ilp_out/series', 'bucket_minutes=0')
+        self.assertQueryError(400, '/tables/ilp_out/series',
+                              'start=2018-01-01T00:00:00Z&end=2018-05-01T00:00:00Z&bucket_minutes=1')
+
+    def test_not_found(self):
+        self.assertQueryError(404, '/tables/nope/latest')
+        self.assertQueryError(404, '/tables/ilp_out/average')
+        self.assertQueryError(404, '/')
+
+    def test_cache_is_dropped_when_file_changes(self):
+        self.assertEqual(self.api.query('/tables/ilp_out/latest', '')['latest']['temperature'], 11.5)
+
+        # Make sure that the write changes the modification time
+        os.utime(self.file_name, (0, 0))
+
+        conn = sqlite3.connect(self.file_name)
+        conn.execute("INSERT INTO ilp_out (ts, temperature) VALUES ('2018-05-01T02:00:00+00:00', 20.5)")
+        conn.commit()
+        conn.close()
+
+        self.assertEqual(self.api.query('/tables/ilp_out/latest', '')['latest']['temperature'], 20.5)
+
+
+class TtlLruCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.cache = TtlLruCache(max_size=2, ttl=60, clock=self.clock)
+
+    def test_version_change(self):
+        self.cache.put('a', 1, 'value')
+        self.assertEqual(self.cache.get('a', 1), 'value')
+        self.assertEqual(self.cache.get('a', 2), None)
+
+    def test_ttl(self):
+        self.cache.put('a', 1, 'value')
+        self.clock.now += 60
+        self.assertEqual(self.cache.get('a', 1), 'value')
+        self.clock.now += 1
+        self.assertEqual(self.cache.get('a', 1), None)
+
+    def test_least_recently_used_is_dropped(self):
+        self.cache.put('a', 1, 'a')
+        self.cache.put('b', 1, 'b')
+        self.cache.get('a', 1)
+        self.cache.put('c', 1, 'c')
+
+        self.assertEqual(self.cache.get('b', 1), None)
+        self.assertEqual(self.cache.get('a', 1), 'a')
+        self.assertEqual(self.cache.get('c', 1), 'c')
+
+
+class QueryServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, 'ilp_out.sqlite')
+        create_fixture(self.file_name)
+        self.server = QueryServer(('127.0.0.1', 0), QueryApi([self.file_name], TtlLruCache()))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.directory)
+
+    def get(self, path):
+        try:
+            response = urlopen('http://127.0.0.1:%d%s' % (self.server.server_address[1], path))
+        except HTTPError as e:
+            response = e
+        return response.getcode(), json.loads(response.read().decode('utf-8'))
+
+    def test_ok(self):
+        self.assertEqual(self.get('/tables'), (200, {'tables': ['ilp_out']}))
+
+    def test_error_is_json(self):
+        status, result = self.get('/tables/nope/latest')
+        self.assertEqual(status, 404)
+        self.assertIn('error', result)
+
+    def test_missing_database(self):
+        os.remove(self.file_name)
+        status, result = self.get('/tables')
+        self.assertEqual(status, 503)
+        self.assertIn('error', result)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import read_1_wire_temperature
+import retry_policy
+from read_1_wire_temperature import RingBuffer, Sensor, parse_w1_slave, read_raw_temp
+
+VALID = b'72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n72 01 4b 46 7f ff 0e 10 57 t=23125\n'
+NEGATIVE = b'5e ff 4b 46 7f ff 02 10 c6 : crc=c6 YES\n5e ff 4b 46 7f ff 02 10 c6 t=-10125\n'
+CRC_FAILED = b'72 01 4b 46 7f ff 0e 10 57 : crc=00 NO\n72 01 4b 46 7f ff 0e 10 57 t=23125\n'
+INITIALIZING = b'50 05 4b 46 7f ff 0c 10 1c : crc=1c YES\n50 05 4b 46 7f ff 0c 10 1c t=85000\n'
+ZERO = b'00 00 4b 46 7f ff 00 10 a8 : crc=a8 YES\n00 00 4b 46 7f ff 00 10 a8 t=0\n'
+TRUNCATED = b'72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\n72 01 4b 46 7f'
+CRLF = b'72 01 4b 46 7f ff 0e 10 57 : crc=57 YES\r\n72 01 4b 46 7f ff 0e 10 57 t=23125\r\n'
+
+
+def parse(contents):
+    buffer = bytearray(read_1_wire_temperature.W1_SLAVE_MAX_SIZE)
+    buffer[:len(contents)] = contents
+    return parse_w1_slave(buffer, len(contents))
+
+
+class ParseW1SlaveTest(unittest.TestCase):
+
+    def test_valid(self):
+        self.assertEqual(parse(VALID), 23125)
+
+    def test_negative(self):
+        self.assertEqual(parse(NEGATIVE), -10125)
+
+    def test_crc_failed(self):
+        self.assertRaises(ValueError, parse, CRC_FAILED)
+
+    def test_initializing_is_parsed(self):
+        # Rejected by read_raw_temp, not by the parser
+        self.assertEqual(parse(INITIALIZING), 85000)
+
+    def test_truncated(self):
+        self.assertRaises(ValueError, parse, TRUNCATED)
+        self.assertRaises(ValueError, parse, VALID[:30])
+        self.assertRaises(ValueError, parse, b'')
+
+    def test_crlf(self):
+        self.assertEqual(parse(CRLF), 23125)
+
+    def test_trailing_junk(self):
+        self.assertRaises(ValueError, parse, VALID + b'x')
+
+
+class ReadRawTempTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sensor = Sensor(os.path.join(self.directory, 'w1_slave'), 4)
+
+        # Fail fast instead of retrying for a minute
+        self.tries = retry_policy.sensor_read.tries
+        retry_policy.sensor_read.tries = 1
+
+    def tearDown(self):
+        retry_policy.sensor_read.tries = self.tries
+        shutil.rmtree(self.directory)
+
+    def write(self, contents):
+        with open(self.sensor.device_file_name, 'wb') as f:
+            f.write(contents)
+
+    def test_valid(self):
+        self.write(VALID)
+        self.assertEqual(read_raw_temp(self.sensor, False), 23125)
+
+    def test_initializing(self):
+        self.write(INITIALIZING)
+        self.assertRaises(ValueError, read_raw_temp, self.sensor, False)
+
+    def test_zero(self):
+        self.write(ZERO)
+        self.assertEqual(read_raw_temp(self.sensor, False), 0)
+        self.assertRaises(ValueError, read_raw_temp, self.sensor, True)
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_wraparound(self):
+        ring = RingBuffer(3)
+
+        for i in range(5):
+            ring.append(i, i * 10)
+
+        # Samples 2, 3 and 4 are left
+        self.assertEqual(ring.count, 3)
+        self.assertEqual(ring.median(3), (3, 30))
+        self.assertEqual(ring.median(1), (4, 40))
+
+    def test_median_of_more_than_count(self):
+        ring = RingBuffer(5)
+        ring.append('a', 300)
+        ring.append('b', 100)
+
+        # Upper middle of two
+        self.assertEqual(ring.median(5), ('a', 300))
+
+    def test_median_odd(self):
+        ring = RingBuffer(5)
+
+        for timestamp, value in [('a', 5), ('b', 1), ('c', 4), ('d', 2), ('e', 3)]:
+            ring.append(timestamp, value)
+
+        self.assertEqual(ring.median(5), ('e', 3))
+
+    def test_median_ties_keep_sample_order(self):
+        ring = RingBuffer(4)
+
+        for timestamp, value in [('a', 7), ('b', 1), ('c', 7), ('d', 7)]:
+            ring.append(timestamp, value)
+
+        # Sorted: b, a, c, d
+        self.assertEqual(ring.median(4), ('c', 7))
+        self.assertEqual(ring.median(3), ('c', 7))
+
+    def test_empty(self):
+        self.assertRaises(ValueError, RingBuffer(3).median, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
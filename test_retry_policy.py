@@ -0,0 +1,149 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import shutil
+import tempfile
+import unittest
+
+from retry_policy import CircuitBreaker, CircuitOpenError, RetryPolicy
+
+
+class Clock(object):
+    """Time that moves only when sleep is called or the test moves it."""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Failing(object):
+    """Callable that fails the first failures calls, each taking duration seconds."""
+
+    def __init__(self, clock, failures, duration=0):
+        self.clock = clock
+        self.failures = failures
+        self.duration = duration
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        self.clock.now += self.duration
+        if self.calls <= self.failures:
+            raise ValueError('failure %d' % self.calls)
+        return 'ok'
+
+
+class RetryPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def policy(self, **kw):
+        return RetryPolicy('test', ValueError, jitter=0, sleep=self.clock.sleep, clock=self.clock, **kw)
+
+    def test_retries_until_success(self):
+        f = Failing(self.clock, 2)
+        self.assertEqual(self.policy(tries=3, delay=1).call(f), 'ok')
+        self.assertEqual(f.calls, 3)
+        self.assertEqual(self.clock.sleeps, [1, 2])
+
+    def test_gives_up_after_tries(self):
+        f = Failing(self.clock, 10)
+        self.assertRaises(ValueError, self.policy(tries=3, delay=1).call, f)
+        self.assertEqual(f.calls, 3)
+
+    def test_gives_up_at_deadline(self):
+        # Attempts of 4 seconds and pauses of 1, 2, 4... The third pause would end past 10 seconds.
+        f = Failing(self.clock, 10, duration=4)
+        self.assertRaises(ValueError, self.policy(tries=10, delay=1, deadline=10).call, f)
+        self.assertEqual(f.calls, 2)
+        self.assertLessEqual(self.clock.now - 1000, 10)
+
+    def test_attempt_timeout_is_capped_by_deadline(self):
+        policy = self.policy(tries=10, delay=1, deadline=10, timeout=8)
+        timeouts = []
+
+        def f():
+            timeouts.append(policy.attempt_timeout())
+            self.clock.now += 4
+            raise ValueError()
+
+        self.assertRaises(ValueError, policy.call, f)
+        # 10 seconds left, then 10 - 4 - 1 = 5
+        self.assertEqual(timeouts, [8, 5])
+        self.assertEqual(policy.attempt_timeout(), 8)
+
+    def test_other_exceptions_are_not_retried(self):
+        def f():
+            raise KeyError()
+
+        self.assertRaises(KeyError, self.policy(tries=3).call, f)
+        self.assertEqual(self.clock.sleeps, [])
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.clock = Clock()
+        self.breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60, state_dir=self.directory,
+                                      clock=self.clock)
+        self.policy = RetryPolicy('test', ValueError, tries=1, breaker=self.breaker, sleep=self.clock.sleep,
+                                  clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_opens_after_threshold(self):
+        f = Failing(self.clock, 10)
+
+        self.assertRaises(ValueError, self.policy.call, f)
+        self.assertRaises(ValueError, self.policy.call, f)
+        self.assertRaises(CircuitOpenError, self.policy.call, f)
+        self.assertEqual(f.calls, 2)
+
+    def test_success_resets_failures(self):
+        self.assertRaises(ValueError, self.policy.call, Failing(self.clock, 1))
+        self.assertEqual(self.policy.call(Failing(self.clock, 0)), 'ok')
+        self.assertRaises(ValueError, self.policy.call, Failing(self.clock, 1))
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_trial(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertFalse(self.breaker.allow())
+
+        self.clock.now += 60
+
+        # Only one trial call is let through
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+        # A failed trial opens the circuit for another reset_timeout
+        self.breaker.record_failure()
+        self.clock.now += 59
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+
+        # A successful trial closes it
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.allow())
+
+    def test_unwritable_state_dir(self):
+        breaker = CircuitBreaker('test', state_dir=self.directory + '/missing')
+        breaker.record_failure()
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from time_validity import CLOCK_JUMP_TOLERANCE, TimeValidity
+
+
+class Status(object):
+    """Clock status source that counts how many times it was asked."""
+
+    def __init__(self, synchronized):
+        self.synchronized = synchronized
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return self.synchronized
+
+
+class TimeValidityTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.wall = 1500000000.0
+        self.uptime = 100.0
+        self.status = Status(True)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def time_validity(self, cache_file=None):
+        return TimeValidity(self.status, ttl=3600, cache_file=cache_file or os.path.join(self.directory, 'cache'),
+                            clock=lambda: self.wall, uptime=lambda: self.uptime)
+
+    def advance(self, seconds, wall_seconds=None):
+        self.uptime += seconds
+        self.wall += seconds if wall_seconds is None else wall_seconds
+
+    def test_positive_result_is_cached_for_ttl(self):
+        self.assertTrue(self.time_validity().is_valid())
+
+        # Every run is a new process, so a new instance reads the cache file
+        self.advance(3599)
+        self.assertTrue(self.time_validity().is_valid())
+        self.assertEqual(self.status.calls, 1)
+
+        self.advance(1)
+        self.assertTrue(self.time_validity().is_valid())
+        self.assertEqual(self.status.calls, 2)
+
+    def test_negative_result_is_not_cached(self):
+        self.status.synchronized = False
+        self.assertFalse(self.time_validity().is_valid())
+
+        self.status.synchronized = True
+        self.advance(1)
+        self.assertTrue(self.time_validity().is_valid())
+        self.assertEqual(self.status.calls, 2)
+
+    def test_clock_jump_drops_cache(self):
+        self.assertTrue(self.time_validity().is_valid())
+
+        self.status.synchronized = False
+        self.advance(60, wall_seconds=60 + CLOCK_JUMP_TOLERANCE + 1)
+        self.assertFalse(self.time_validity().is_valid())
+        self.assertEqual(self.status.calls, 2)
+
+    def test_small_drift_keeps_cache(self):
+        self.assertTrue(self.time_validity().is_valid())
+
+        self.status.synchronized = False
+        self.advance(60, wall_seconds=60 + CLOCK_JUMP_TOLERANCE - 1)
+        self.assertTrue(self.time_validity().is_valid())
+
+    def test_reboot_drops_cache(self):
+        self.assertTrue(self.time_validity().is_valid())
+
+        self.status.synchronized = False
+        self.uptime = 10.0
+        self.assertFalse(self.time_validity().is_valid())
+        self.assertEqual(self.status.calls, 2)
+
+    def test_failed_cache_write_is_still_valid(self):
+        time_validity = self.time_validity(os.path.join(self.directory, 'missing', 'cache'))
+        self.assertTrue(time_validity.is_valid())
+        self.assertTrue(time_validity.is_valid())
+        self.assertEqual(self.status.calls, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
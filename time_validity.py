@@ -0,0 +1,159 @@
+# coding=utf-8
+from __future__ import unicode_literals
+
+import ctypes
+import ctypes.util
+import json
+import os
+import tempfile
+import time
+
+import helpers
+
+# Seconds to trust a positive sync check. TIME_CHECK_TTL in the environment or .env overrides.
+TIME_CHECK_TTL = 3600
+
+# Allowed difference in seconds between wall clock and uptime progress before a clock jump is suspected
+CLOCK_JUMP_TOLERANCE = 5
+
+TIMESYNCD_SYNCHRONIZED_FILE = '/run/systemd/timesync/synchronized'
+
+TIME_ERROR = 5  # adjtimex return value when the clock is not synchronized
+STA_UNSYNC = 0x0040
+
+
+class Timex(ctypes.Structure):
+    # struct timex from <sys/timex.h>
+    _fields_ = [
+        ('modes', ctypes.c_uint),
+        ('offset', ctypes.c_long),
+        ('freq', ctypes.c_long),
+        ('maxerror', ctypes.c_long),
+        ('esterror', ctypes.c_long),
+        ('status', ctypes.c_int),
+        ('constant', ctypes.c_long),
+        ('precision', ctypes.c_long),
+        ('tolerance', ctypes.c_long),
+        ('time_sec', ctypes.c_long),
+        ('time_usec', ctypes.c_long),
+        ('tick', ctypes.c_long),
+        ('ppsfreq', ctypes.c_long),
+        ('jitter', ctypes.c_long),
+        ('shift', ctypes.c_int),
+        ('stabil', ctypes.c_long),
+        ('jitcnt', ctypes.c_long),
+        ('calcnt', ctypes.c_long),
+        ('errcnt', ctypes.c_long),
+        ('stbcnt', ctypes.c_long),
+        ('tai', ctypes.c_int),
+        ('padding', ctypes.c_int * 11),
+    ]
+
+
+def adjtimex_status():
+    """Kernel clock sync status. Returns None if adjtimex is not available."""
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        adjtimex = libc.adjtimex
+    except (OSError, AttributeError):
+        return None
+
+    timex = Timex()  # modes=0 only reads the status
+    state = adjtimex(ctypes.byref(timex))
+
+    if state == -1:
+        return None
+
+    return state != TIME_ERROR and not timex.status & STA_UNSYNC
+
+
+def timesyncd_status():
+    """systemd-timesyncd creates the file after the first successful sync. Returns None if not synced."""
+    return True if os.path.exists(TIMESYNCD_SYNCHRONIZED_FILE) else None
+
+
+def clock_status():
+    status = adjtimex_status()
+    if status is None:
+        status = timesyncd_status()
+    return bool(status)
+
+
+def read_uptime():
+    with open('/proc/uptime') as f:
+        return float(f.read().split()[0])
+
+
+class TimeValidity(object):
+    """
+    Checks that the system clock is synchronized. A positive result is cached in a file for ttl
+    seconds so that consecutive runs don't need to check again. The cache is dropped early if the
+    wall clock and uptime have advanced differently, which means that the clock has jumped.
+    """
+
+    def __init__(self, status_source=clock_status, ttl=TIME_CHECK_TTL, cache_file=None, clock=time.time,
+                 uptime=read_uptime):
+        self.status_source = status_source
+        self.ttl = ttl
+        self.cache_file = cache_file or os.path.join(tempfile.gettempdir(), 'raspberry-sensors-time-valid')
+        self.clock = clock
+        self.uptime = uptime
+
+    def read_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def write_cache(self, wall, uptime):
+        # The cache only saves a status check next time. A full or read-only disk must not fail the reading.
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump({'wall': wall, 'uptime': uptime}, f)
+        except (IOError, OSError):
+            pass
+
+    def cached_valid(self, wall, uptime):
+        cache = self.read_cache()
+
+        if not cache:
+            return False
+
+        wall_elapsed = wall - cache['wall']
+        uptime_elapsed = uptime - cache['uptime']
+
+        if uptime_elapsed < 0:
+            # Rebooted
+            return False
+
+        if abs(wall_elapsed - uptime_elapsed) > CLOCK_JUMP_TOLERANCE:
+            return False
+
+        return uptime_elapsed < self.ttl
+
+    def is_valid(self):
+        wall = self.clock()
+        uptime = self.uptime()
+
+        if self.cached_valid(wall, uptime):
+            return True
+
+        if not self.status_source():
+            return False
+
+        self.write_cache(wall, uptime)
+        return True
+
+
+time_validity = None
+
+
+def is_valid():
+    global time_validity
+
+    if time_validity is None:
+        time_validity = TimeValidity(ttl=int(helpers.getenv('TIME_CHECK_TTL', TIME_CHECK_TTL)))
+
+    return time_validity.is_valid()
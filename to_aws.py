@@ -3,10 +3,11 @@ import argparse
 import json
 import logging
 
-from retry import retry
-
+import config
 import helpers
+import metrics
 import requests
+import retry_policy
 
 
 logger = logging.getLogger('to_sqlite')
@@ -18,15 +19,52 @@ logger.setLevel(logging.DEBUG)
 logger.info('----- START -----')
 
 
-@retry(tries=10, delay=20)
+@retry_policy.aws
 def send_to_aws(name, data_in):
+    metrics.inc('http_request_attempts_total', target='aws', endpoint='addOne')
+
     data = {
         'sensorId': name,
         'ts': data_in['ts'],
         'temperature': data_in['temperature'],
     }
 
-    requests.post(helpers.STORAGE_ROOT_URL + 'addOne', data=json.dumps(data))
+    with metrics.span('http_request', target='aws', endpoint='addOne'):
+        r = requests.post(helpers.storage_root_url() + 'addOne', data=json.dumps(data),
+                          timeout=retry_policy.aws.attempt_timeout())
+    r.raise_for_status()
+
+
+@retry_policy.aws
+def get_max_batch_size(name):
+    """Most items the storage accepts in one add request."""
+    metrics.inc('http_request_attempts_total', target='aws', endpoint='status')
+
+    with metrics.span('http_request', target='aws', endpoint='status'):
+        r = requests.get(helpers.storage_root_url() + 'status', params={'sensorId': name},
+                         timeout=retry_policy.aws.attempt_timeout())
+    r.raise_for_status()
+
+    return r.json()['config']['maxAddBatchSize']
+
+
+@retry_policy.aws
+def send_batch_to_aws(name, rows):
+    metrics.inc('http_request_attempts_total', target='aws', endpoint='add')
+
+    data = {
+        'sensorId': name,
+        'items': [
+            {'ts': row['ts'], 'temperature': row['temperature']}
+            for row
+            in rows
+        ],
+    }
+
+    with metrics.span('http_request', target='aws', endpoint='add'):
+        r = requests.post(helpers.storage_root_url() + 'add', data=json.dumps(data),
+                          timeout=retry_policy.aws.attempt_timeout())
+    r.raise_for_status()
 
 
 @helpers.exception(logger=logger)
@@ -35,13 +73,27 @@ def main():
     parser = argparse.ArgumentParser(
         description='Read temperature from stdin and send it to AWS.')
 
+    parser.add_argument('--config', type=str,
+                        help='Sensor config file. Sends as the sensor given by --sensor, to the storage_root_url '
+                             'of the config. Replaces the other arguments.')
+    parser.add_argument('--sensor', type=str, help='Name of the sensor in the config file. Not needed for one sensor.')
     parser.add_argument('--name', type=str, help='Name of the sensor.')
 
     args = parser.parse_args()
 
+    name = args.name
+
+    if args.config:
+        sensor_config = config.load(args.config)
+        config.apply(sensor_config)
+        # Same sensor id as scheduler.py and sync_sqlite_to_aws.py use
+        name = config.find_sensor(sensor_config, args.sensor).table_name
+
+    metrics.configure('to_aws')
+
     data_in = helpers.read_stdin()
 
-    send_to_aws(args.name, data_in)
+    send_to_aws(name, data_in)
 
     # data_out = json.dumps(data_in)
 
@@ -5,19 +5,23 @@ import itertools
 import logging
 import socket
 import sqlite3
+import threading
 import time
+from collections import deque
 from decimal import Decimal
-from functools import wraps
-from operator import itemgetter
+from multiprocessing.pool import ThreadPool
 
 import arrow
 import httplib2
 import pygsheets
 import requests
 from OpenSSL import SSL
-from retry import retry
 
+import config
 import helpers
+import metrics
+import retry_policy
+from aggregates import average, sqlite_get_last_row, sqlite_get_last_two_rows, sqlite_rows_for_time_range
 
 logger = logging.getLogger('to_sheet')
 handler = logging.FileHandler('to_sheet.log')
@@ -27,58 +31,36 @@ logger.addHandler(handler)
 logger.setLevel(logging.DEBUG)
 logger.info('----- START -----')
 
+NETWORK_ERRORS = (httplib.HTTPException, httplib2.HttpLib2Error, socket.error, requests.RequestException, SSL.Error,
+                  pygsheets.exceptions.RequestError, retry_policy.CircuitOpenError)
 
-def timing(f):
-    @wraps(f)
-    def timing_wrap(*args, **kw):
-        ts = time.time()
-        result = f(*args, **kw)
-        te = time.time()
-        logger.debug('func:%r args:[%r, %r] took: %2.4f sec' % (f.__name__, args, kw, te-ts))
-        return result
-    return timing_wrap
+local = threading.local()
 
 
-def sqlite_get_rows_between_ts(cursor, table_name, start_ts, end_ts):
-    cursor.execute(
-        'SELECT id, ts, temperature FROM %s WHERE ts>? and ts<=? ORDER BY id' % table_name, (start_ts, end_ts))
-    return cursor.fetchall()
+class RateLimiter(object):
+    """Blocks until a call fits in max_calls per period seconds. Shared by all worker threads."""
 
+    def __init__(self, max_calls, period):
+        self.max_calls = max_calls
+        self.period = period
+        self.calls = deque()
+        self.lock = threading.Lock()
 
-def sqlite_get_last_row(cursor, table_name):
-    cursor.execute('SELECT id, ts, temperature FROM %s ORDER BY id DESC LIMIT 1' % table_name)
-    return cursor.fetchone()
+    def acquire(self):
+        with self.lock:
+            while True:
+                now = time.time()
+                while self.calls and self.calls[0] <= now - self.period:
+                    self.calls.popleft()
+                if len(self.calls) < self.max_calls:
+                    self.calls.append(now)
+                    return
+                metrics.inc('quota_waits_total', target='gsheets')
+                time.sleep(self.calls[0] + self.period - now)
 
 
-def sqlite_get_last_two_rows(cursor, table_name):
-    cursor.execute('SELECT id, ts, temperature FROM %s ORDER BY id DESC LIMIT 2' % table_name)
-    return cursor.fetchall()
-
-
-def highest_and_lowest_temperature(cursor, table_name, start_datetime, end_datetime, average_minutes):
-
-    sqlite_rows = sqlite_get_rows_between_ts(
-        cursor,
-        table_name,
-        datetime_to_utc_string_datetime(start_datetime),
-        datetime_to_utc_string_datetime(end_datetime))
-
-    if not sqlite_rows:
-        return [[]] * 2
-
-    min_temperature_sqlite_row = min(sqlite_rows, key=itemgetter(2))
-    max_temperature_sqlite_row = max(sqlite_rows, key=itemgetter(2))
-
-    min_row_average = average(cursor, table_name, min_temperature_sqlite_row[1], average_minutes)
-    max_row_average = average(cursor, table_name, max_temperature_sqlite_row[1], average_minutes)
-
-    min_temperature_sqlite_row += (min_row_average,)
-    max_temperature_sqlite_row += (max_row_average,)
-
-    if min_temperature_sqlite_row[1] > max_temperature_sqlite_row[1]:
-        return min_temperature_sqlite_row, max_temperature_sqlite_row
-    else:
-        return max_temperature_sqlite_row, min_temperature_sqlite_row
+# Google Sheets API allows 100 requests per 100 seconds per user
+quota = RateLimiter(config.DEFAULT_MAX_REQUESTS_PER_100_SECONDS, 100)
 
 
 def first_day_interval():
@@ -130,27 +112,6 @@ def filtered_sqlite_rows(cursor, table_name, average_minutes):
         yield row2
 
 
-def sqlite_rows_for_time_range(cursor, table_name, start_datetime, hours, average_minutes):
-    end_datetime = start_datetime
-    start_datetime = end_datetime.replace(hours=-hours)
-    min_max_rows = highest_and_lowest_temperature(cursor, table_name, start_datetime, end_datetime, average_minutes)
-    return start_datetime, min_max_rows[0], min_max_rows[1]
-
-
-def average(cursor, table_name, sqlite_ts, average_minutes):
-    utc_aware = arrow.get(sqlite_ts).shift(minutes=-average_minutes)
-
-    sqlite_rows = sqlite_get_rows_between_ts(
-        cursor,
-        table_name,
-        datetime_to_utc_string_datetime(utc_aware),
-        sqlite_ts)
-
-    temperatures = map(itemgetter(2), sqlite_rows)
-
-    return helpers.decimal_round(Decimal(sum(temperatures)) / Decimal(len(temperatures)), decimals=2)
-
-
 def convert_sqlite_row_to_gspread(sqlite_row, num_of_columns):
 
     gspread_row = list(sqlite_row)
@@ -167,8 +128,12 @@ def convert_sqlite_row_to_gspread(sqlite_row, num_of_columns):
     return gspread_row
 
 
-@retry(tries=3, delay=30)
+@retry_policy.gsheets
+@metrics.timed('http_request', target='gsheets', endpoint='update_cells')
 def write_to_gspread(wks, sqlite_rows):
+    metrics.inc('http_request_attempts_total', target='gsheets', endpoint='update_cells')
+    retry_policy.set_socket_timeout(retry_policy.gsheets)
+
     num_of_columns = max(map(len, sqlite_rows))
 
     gspread_rows = [convert_sqlite_row_to_gspread(sqlite_row, num_of_columns) for sqlite_row in sqlite_rows]
@@ -177,82 +142,167 @@ def write_to_gspread(wks, sqlite_rows):
 
     resize_sheet(wks, len(gspread_rows) + start_row - 1, num_of_columns)
 
+    quota.acquire()
     wks.update_cells((start_row, 1), [gspread_rows[0]])
     logger.info('Manually updated %s', gspread_rows[0])
     gspread_rows = gspread_rows[1:]
     start_row += 1
 
     logger.info('Updating %d rows', len(gspread_rows))
+    quota.acquire()
     wks.update_cells((start_row, 1), gspread_rows)
 
 
 def resize_sheet(wks, row_count, col_count):
     if wks.rows < row_count:
         logger.info('Resize rows %d -> %d', wks.rows, row_count)
+        quota.acquire()
         wks.rows = row_count
     if wks.cols < col_count:
         logger.info('Resize cols %d -> %d', wks.cols, col_count)
+        quota.acquire()
         wks.cols = col_count
 
 
-@retry(tries=3, delay=30)
-@timing
+def get_client():
+    # httplib2 connections can't be shared between threads, so every worker thread authorizes its own
+    # client. The saved credentials are reused, so this does not start a new authorization flow.
+    client = getattr(local, 'client', None)
+    if client is None:
+        client = local.client = pygsheets.authorize(outh_file='client_secret.json', outh_nonlocal=True)
+    return client
+
+
+@retry_policy.gsheets
+@metrics.timed('http_request', target='gsheets', endpoint='worksheet')
 def get_worksheet(sheet_key, sheet_name):
-    gc = pygsheets.authorize(outh_file='client_secret.json', outh_nonlocal=True)
+    metrics.inc('http_request_attempts_total', target='gsheets', endpoint='worksheet')
+    retry_policy.set_socket_timeout(retry_policy.gsheets)
+
+    gc = get_client()
+
+    quota.acquire()
     sh = gc.open_by_key(sheet_key)
 
+    quota.acquire()
     wks = sh.worksheet_by_title(sheet_name)
     return wks
 
 
-def datetime_to_utc_string_datetime(utc_aware):
-    return utc_aware.to('utc').format('YYYY-MM-DDTHH:mm:ssZZ')  # 2016-09-21T08:50:28+00:00
-
-
 def main():
 
     parser = argparse.ArgumentParser(
         description='Sync sqlite to Google spreadsheet.')
 
-    parser.add_argument('--file-name', type=str, required=True, help='Sqlite database file name.')
-    parser.add_argument('--table-name', type=str, required=True, help='Sqlite database table name.')
-    parser.add_argument('--sheet-key', type=str, required=True, help='Google spreadsheet sheet key.')
-    parser.add_argument('--sheet-name', type=str, required=True, help='Google spreadsheet sheet name.')
+    parser.add_argument('--config', type=str,
+                        help='Sensor config file. Updates all sheets in it. Replaces the other arguments.')
+    parser.add_argument('--file-name', type=str, help='Sqlite database file name.')
+    parser.add_argument('--table-name', type=str, help='Sqlite database table name.')
+    parser.add_argument('--sheet-key', type=str, help='Google spreadsheet sheet key.')
+    parser.add_argument('--sheet-name', type=str, help='Google spreadsheet sheet name.')
     parser.add_argument('--average-minutes', type=int, default=1440, help='Period in minutes to calculate average.')
 
     args = parser.parse_args()
 
-    conn = sqlite3.connect(args.file_name)
-    cursor = conn.cursor()
+    if args.config:
+        sensor_config = config.load(args.config)
+        targets = sensor_config.sheet_targets
+        max_workers, max_requests = sensor_config.max_workers, sensor_config.max_requests_per_100_seconds
+    elif args.file_name and args.table_name and args.sheet_key and args.sheet_name:
+        targets, max_workers, max_requests = [args], 1, config.DEFAULT_MAX_REQUESTS_PER_100_SECONDS
+    else:
+        parser.error('Either --config or all of --file-name, --table-name, --sheet-key and --sheet-name are required.')
+
+    metrics.configure('to_sheet')
+
+    # pygsheets has no timeout option. Connections are kept per thread, so a socket can outlive the
+    # attempt that opened it, but never waits longer than the per attempt timeout.
+    socket.setdefaulttimeout(retry_policy.gsheets.timeout)
 
     logging.captureWarnings(True)
     logging.getLogger().setLevel(logging.WARNING)
 
-    try:
-        do_gspread_stuff(args, cursor)
-    except (httplib.HTTPException, httplib2.HttpLib2Error, socket.error, requests.RequestException, SSL.Error,
-            pygsheets.exceptions.RequestError):
-        # pygsheets.exceptions.RequestError usually means Timeout
-        pass
+    quota.max_calls = max_requests
+
+    if targets:
+        sync_targets(targets, max_workers)
 
-    conn.close()
     logger.info('-----  END  -----')
 
 
-@timing
-def do_gspread_stuff(args, cursor):
-    wks = get_worksheet(args.sheet_key, args.sheet_name)
+@metrics.timed()
+def sync_targets(targets, max_workers):
+
+    # Aggregate everything first. Targets with the same table share the result.
+    all_sqlite_rows = get_all_sqlite_rows(targets)
 
-    sqlite_rows = get_sqlite_rows(args, cursor)
+    # Targets that could not be aggregated are skipped
+    targets_and_rows = [(target, sqlite_rows) for target, sqlite_rows in zip(targets, all_sqlite_rows) if sqlite_rows]
 
-    write_to_gspread(wks, sqlite_rows)
+    if not targets_and_rows:
+        return
 
+    pool = ThreadPool(min(max_workers, len(targets_and_rows)))
+    try:
+        pool.map(lambda target_and_rows: update_target(*target_and_rows), targets_and_rows)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def update_target(target, sqlite_rows):
+    try:
+        wks = get_worksheet(target.sheet_key, target.sheet_name)
+        write_to_gspread(wks, sqlite_rows)
+    except NETWORK_ERRORS as e:
+        # pygsheets.exceptions.RequestError usually means Timeout
+        logger.warning('Updating sheet %s failed: %r', target.sheet_name, e)
+    # One failing sheet must not stop the others
+    # noinspection PyBroadException
+    except Exception as e:
+        logger.exception('Updating sheet %s failed: %r', target.sheet_name, e)
 
-@timing
+
+@metrics.timed()
+def get_all_sqlite_rows(targets):
+
+    connections = {}
+    sqlite_rows_by_key = {}
+    all_sqlite_rows = []
+
+    try:
+        for target in targets:
+            key = (target.file_name, target.table_name, target.average_minutes)
+
+            if key not in sqlite_rows_by_key:
+                if target.file_name not in connections:
+                    connections[target.file_name] = sqlite3.connect(target.file_name)
+                cursor = connections[target.file_name].cursor()
+                try:
+                    sqlite_rows_by_key[key] = get_sqlite_rows(target, cursor)
+                # A missing or broken table must not stop the other sheets
+                # noinspection PyBroadException
+                except Exception as e:
+                    logger.exception('Reading %s of %s failed: %r', target.table_name, target.file_name, e)
+                    sqlite_rows_by_key[key] = None
+
+            all_sqlite_rows.append(sqlite_rows_by_key[key])
+    finally:
+        for conn in connections.values():
+            conn.close()
+
+    return all_sqlite_rows
+
+
+@metrics.timed()
 def get_sqlite_rows(args, cursor):
 
     last_two_sqlite_rows = sqlite_get_last_two_rows(cursor, args.table_name)
 
+    if not last_two_sqlite_rows:
+        logger.warning('No rows in %s of %s. Skipping.', args.table_name, args.file_name)
+        return []
+
     sqlite_rows = filtered_sqlite_rows(cursor, args.table_name, args.average_minutes)
 
     if len(last_two_sqlite_rows) >= 2 \
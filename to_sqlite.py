@@ -2,11 +2,14 @@
 import argparse
 import json
 import logging
+import os
 import sqlite3
 
-from retry import retry
-
+import config
 import helpers
+import metrics
+import retry_policy
+from aggregates import sqlite_get_table_names
 
 
 logger = logging.getLogger('to_sqlite')
@@ -18,6 +21,14 @@ logger.setLevel(logging.DEBUG)
 logger.info('----- START -----')
 
 
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    UPSERT = 'INSERT INTO %s (ts, temperature) VALUES (?, ?) ' \
+             'ON CONFLICT(ts) DO UPDATE SET temperature=excluded.temperature'
+else:
+    # No upsert in older sqlite. Replacing gives the row a new id.
+    UPSERT = 'INSERT OR REPLACE INTO %s (ts, temperature) VALUES (?, ?)'
+
+
 def init_sqlite(c, table_name):
     c.execute("""CREATE TABLE IF NOT EXISTS %s
                   (
@@ -26,19 +37,74 @@ def init_sqlite(c, table_name):
                       temperature DECIMAL(6,2) NOT NULL
                   )""" % table_name)
 
+    try:
+        create_ts_index(c, table_name)
+    except sqlite3.IntegrityError:
+        # Table from before the unique index. Clean it once.
+        dedup_table(c, table_name)
+        create_ts_index(c, table_name)
+
+
+def create_ts_index(c, table_name):
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS %s_ts ON %s (ts)' % (table_name, table_name))
+
+
+def dedup_table(c, table_name):
+    """Delete rows with the same ts, keeping the latest written. Returns the number of deleted rows."""
+    c.execute('DELETE FROM %s WHERE id NOT IN (SELECT MAX(id) FROM %s GROUP BY ts)' % (table_name, table_name))
+    logger.info('Deleted %d duplicate rows from %s', c.rowcount, table_name)
+    metrics.inc('sqlite_duplicates_deleted_total', c.rowcount, table=table_name)
+    return c.rowcount
+
 
-@retry(tries=3, delay=10)
 def write_to_sqlite(file_name, table_name, data_in):
+    write_rows_to_sqlite(file_name, table_name, [data_in])
+
+
+@retry_policy.sqlite_write
+def write_rows_to_sqlite(file_name, table_name, rows):
+    """Write rows, replacing earlier rows with the same ts, so that writing the same rows again is harmless."""
+
+    metrics.inc('sqlite_write_attempts_total', table=table_name)
+
+    with metrics.span('sqlite_write', table=table_name):
+        conn = sqlite3.connect(file_name)
+        try:
+            c = conn.cursor()
+
+            init_sqlite(c, table_name)
+
+            c.executemany(UPSERT % table_name, [(row['ts'], row['temperature']) for row in rows])
+
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def dedup_sqlite(file_name, table_names):
+
+    if not os.path.exists(file_name):
+        logger.warning('No file %s. Skipping.', file_name)
+        return
+
     conn = sqlite3.connect(file_name)
-    c = conn.cursor()
+    try:
+        c = conn.cursor()
+
+        existing_table_names = sqlite_get_table_names(c)
 
-    init_sqlite(c, table_name)
+        for table_name in table_names or existing_table_names:
+            # Tables of sensors that have not been read yet don't exist
+            if table_name not in existing_table_names:
+                logger.warning('No table %s in %s. Skipping.', table_name, file_name)
+                continue
 
-    c.execute('INSERT INTO %s (ts, temperature) VALUES (?, ?)' % table_name,
-              (data_in['ts'], data_in['temperature']))
+            print('%s: deleted %d duplicate rows' % (table_name, dedup_table(c, table_name)))
+            create_ts_index(c, table_name)
 
-    conn.commit()
-    conn.close()
+        conn.commit()
+    finally:
+        conn.close()
 
 
 @helpers.exception(logger=logger)
@@ -47,15 +113,44 @@ def main():
     parser = argparse.ArgumentParser(
         description='Read temperature from stdin and write them to sqlite file.')
 
-    parser.add_argument('--file-name', type=str, required=True, help='Sqlite database file name.')
-    parser.add_argument('--table-name', type=str, default='sensor1',
+    parser.add_argument('--config', type=str,
+                        help='Sensor config file. Writes to the table of the sensor given by --sensor. '
+                             'With --dedup cleans the tables of all sensors. Replaces the other arguments.')
+    parser.add_argument('--sensor', type=str, help='Name of the sensor in the config file. Not needed for one sensor.')
+    parser.add_argument('--file-name', type=str, help='Sqlite database file name.')
+    parser.add_argument('--table-name', type=str,
                         help='Sqlite database table name. Defaults to "sensor1".')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Only delete rows with duplicate timestamps and add the unique ts index. '
+                             'Cleans all tables unless --table-name is given.')
 
     args = parser.parse_args()
 
+    if not args.config and not args.file_name:
+        parser.error('Either --config or --file-name is required.')
+
+    metrics.configure('to_sqlite')
+
+    if args.dedup:
+        if args.config:
+            sensor_config = config.load(args.config)
+            for file_name in config.file_names(sensor_config):
+                dedup_sqlite(file_name, [table_name for table_file_name, table_name in config.tables(sensor_config)
+                                         if table_file_name == file_name])
+        else:
+            dedup_sqlite(args.file_name, [args.table_name] if args.table_name else [])
+        logger.info('-----  END  -----')
+        return
+
+    if args.config:
+        sensor = config.find_sensor(config.load(args.config), args.sensor)
+        file_name, table_name = sensor.file_name, sensor.table_name
+    else:
+        file_name, table_name = args.file_name, args.table_name or 'sensor1'
+
     data_in = helpers.read_stdin()
 
-    write_to_sqlite(args.file_name, args.table_name, data_in)
+    write_to_sqlite(file_name, table_name, data_in)
 
     data_out = json.dumps(data_in)
 